@@ -12,56 +12,671 @@ develop a new k8s charm using the Operator Framework:
     https://discourse.charmhub.io/t/4208
 """
 
+import hashlib
+import json
 import logging
+import shlex
+import time
+from collections import Counter
+from typing import NamedTuple
+from urllib.request import urlopen
 
+from lightkube import ApiError
 from ops.charm import CharmBase
+from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
-from ops.pebble import Layer, ConnectionError
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
+from ops.pebble import ConnectionError, Layer
 
-from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
+import compute_resources
+import exposition
+import scrape_config
+from metrics_endpoint import MetricsEndpointProvider
+from sharding import (
+    DEFAULT_RESOURCES,
+    DEFAULT_WEIGHTS,
+    parse_weights,
+    partition_resources,
+)
+from workload_config import (
+    CONFIG_DIR,
+    CONFIG_FILE_PATH,
+    CUSTOM_RESOURCE_STATE_PATH,
+    OPTIONS,
+    ConfigError,
+    compile_config,
+)
 
 logger = logging.getLogger(__name__)
 
+SHARDING_MODES = ("none", "units", "statefulset", "resources")
+MAX_SERIES_ACTIONS = ("block", "deny")
+
+# number of scrape probe readings kept for each process
+PROBE_HISTORY = 12
+# fraction of the scrape timeout beyond which a scrape is reported as slow
+SLOW_SCRAPE_RATIO = 0.8
+
+HEALTHZ_URL = "http://localhost:{port}/healthz"
+READYZ_URL = "http://localhost:{port}/readyz"
+
+# pprof endpoints of each profile, which kube-state-metrics serves on its
+# metrics port
+PROFILES = {
+    "cpu": "/debug/pprof/profile?seconds={duration}",
+    "heap": "/debug/pprof/heap",
+    "goroutine": "/debug/pprof/goroutine",
+}
+PROFILES_DIR = "/var/lib/kube-state-metrics/profiles"
+
+
+class WorkloadService(NamedTuple):
+    """A kube-state-metrics process in the workload container."""
+
+    name: str
+    port: int
+    telemetry_port: int
+    # resources to monitor, if not the ones given by the charm config
+    resources: tuple[str, ...] | None
+    config_file: str
+
+
+def _stale_layer_items(planned, rendered):
+    """Get the services or checks to put in the layer of removed scrape tiers.
+
+    Returns:
+        The names of the planned items which are no longer rendered, and the
+        definitions of the layer's items: the stale ones disabled, and the rendered
+        ones which are still overridden by the layer from when their tier was removed.
+    """
+    stale = [
+        name
+        for name, item in planned.items()
+        if name not in rendered and item.to_dict().get("startup") != "disabled"
+    ]
+    items = {
+        name: item.to_dict()
+        for name, item in rendered.items()
+        if planned.get(name) != item
+    }
+    for name in stale:
+        items[name] = {**planned[name].to_dict(), "startup": "disabled"}
+    return stale, items
+
 
 class KubeStateMetricsOperator(CharmBase):
     """Charm the service."""
 
+    _stored = StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
-        jobs = [
-            {
-                "scrape_interval": self.model.config["scrape-interval"],
-                "static_configs": [
-                    {
-                        "targets": ["*:8080", "*:8081"],
-                    }
-                ],
-            }
-        ]
-
-        self.monitoring = MetricsEndpointProvider(self, jobs=jobs)
+        self._stored.set_default(
+            started_at=None,
+            ready_after=None,
+            pushed_hashes={},
+            resources_patched=False,
+            denied_families=[],
+            over_budget=None,
+            budget_config=None,
+            scrape_probes={},
+            scrape_jobs=None,
+        )
+        self.monitoring = MetricsEndpointProvider(
+            self, jobs=self.scrape_jobs, is_scraped=self._is_scraped
+        )
 
         self.framework.observe(
             self.on.kube_state_metrics_pebble_ready, self._manage_workload
         )
         self.framework.observe(self.on.config_changed, self._manage_workload)
         self.framework.observe(self.on.upgrade_charm, self._manage_workload)
+        self.framework.observe(self.on.cluster_relation_joined, self._manage_workload)
+        self.framework.observe(self.on.cluster_relation_changed, self._manage_workload)
+        self.framework.observe(self.on.cluster_relation_departed, self._manage_workload)
+        self.framework.observe(self.on.leader_elected, self._manage_workload)
+        self.framework.observe(
+            self.on.kube_state_metrics_pebble_check_failed, self._update_status
+        )
+        self.framework.observe(
+            self.on.kube_state_metrics_pebble_check_recovered, self._update_status
+        )
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(
+            self.on.cardinality_report_action, self._on_cardinality_report_action
+        )
+        self.framework.observe(
+            self.on.capture_profiles_action, self._on_capture_profiles_action
+        )
 
     def _manage_workload(self, _):
         """Manage the container using the Pebble API."""
+        self._grant_restart_lock()
+        # reset before validating, since the denied families are merged into a
+        # denylist which a new allowlist would conflict with
+        self._reset_series_budget()
         if not self._validate_config():
             return
+        self._publish_scraped_unit()
+        # the scrape settings only affect the published jobs, so they are applied by
+        # refreshing the relation data rather than by restarting the workload
+        self._publish_scrape_jobs()
+        if not self._check_shard():
+            return
+        for warning in self.workload_config.warnings:
+            logger.warning("Costly config: %s", warning)
+        if not self._patch_resources():
+            return
 
         try:
             container = self.unit.get_container("kube-state-metrics")
-            container.add_layer("kube-state-metrics", self.layer, combine=True)
-            if container.get_service("kube-state-metrics").is_running():
-                container.stop("kube-state-metrics")
-            container.start("kube-state-metrics")
-            self.unit.status = ActiveStatus()
+            layer = self.layer
+            planned = container.get_plan().services
+            changed = [
+                name
+                for name, service in layer.services.items()
+                if planned.get(name) != service
+            ]
+            # restarting a running workload is coordinated across units so that
+            # they don't all re-list every watched resource at the same time
+            restart_running = any(name in planned for name in changed)
+            if restart_running and not self._acquire_restart_lock():
+                self.unit.status = WaitingStatus("Waiting for rolling restart")
+                return
+            self._push_files(container)
+            container.add_layer("kube-state-metrics", layer, combine=True)
+            self._disable_stale_services(container, layer)
+            if changed:
+                # only restart when the rendered service actually differs, since each
+                # restart forces a full re-list of every watched resource
+                logger.info(
+                    "Restarting %s: service definition changed", ", ".join(changed)
+                )
+                container.restart(*changed)
+                self._stored.started_at = time.time()
+                self._stored.ready_after = None
+            else:
+                # start any enabled service which is not running, without restarting
+                container.replan()
+                if self._stored.started_at is None:
+                    self._release_restart_lock()
         except ConnectionError:
             self.unit.status = WaitingStatus("Waiting for Pebble")
+            return
+        self._update_status(None)
+
+    def _on_update_status(self, event):
+        """Periodically check the workload, re-rendering it if the check requires."""
+        counts = self._probe_scrapes()
+        if counts is not None:
+            self._choose_scrape_interval()
+        if counts is not None and self._check_series_budget(counts):
+            self._manage_workload(event)
+        else:
+            self._update_status(event)
+
+    def _on_cardinality_report_action(self, event):
+        """Report the metric families of this unit with the most series and labels.
+
+        The metrics are parsed as they are streamed, so that even a very large
+        exposition can be summarized within the memory of the charm container.
+        """
+        stats = {}
+        try:
+            for service in self.services:
+                url = f"http://localhost:{service.port}/metrics"
+                with urlopen(url, timeout=event.params["timeout"]) as response:
+                    exposition.family_stats(response, stats)
+        except OSError as e:
+            event.fail(f"Failed to fetch metrics: {e}")
+            return
+        event.set_results(
+            {
+                "series": sum(family.series for family in stats.values()),
+                "families": len(stats),
+                "bytes": sum(family.bytes for family in stats.values()),
+                **exposition.report(stats, event.params["top"]),
+            }
+        )
+
+    def _on_capture_profiles_action(self, event):
+        """Capture pprof profiles of a kube-state-metrics process into its container.
+
+        Each profile is stored under a timestamped name, so that the profiles of
+        successive captures can be compared.
+        """
+        names = [name.strip() for name in event.params["profiles"].split(",")]
+        unknown = sorted(set(names) - set(PROFILES))
+        if unknown:
+            event.fail(f"Unknown profiles: {', '.join(unknown)}")
+            return
+        services = {service.name: service for service in self.services}
+        service = services.get(event.params["process"])
+        if service is None:
+            event.fail(f"Unknown process, must be one of: {', '.join(services)}")
+            return
+        container = self.unit.get_container("kube-state-metrics")
+        if not container.can_connect():
+            event.fail("Waiting for Pebble")
+            return
+        duration = event.params["duration"]
+        timestamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        results = {}
+        for name in names:
+            url = f"http://localhost:{service.port}" + PROFILES[name].format(
+                duration=duration
+            )
+            try:
+                # the CPU profile is only returned once it has been collected
+                with urlopen(url, timeout=duration + 60) as response:
+                    profile = response.read()
+            except OSError as e:
+                event.fail(f"Failed to capture {name} profile: {e}")
+                return
+            path = f"{PROFILES_DIR}/{service.name}-{name}-{timestamp}.pb.gz"
+            container.push(path, profile, make_dirs=True)
+            logger.info("Captured %s profile of %s in %s", name, service.name, path)
+            results[name] = {"path": path, "size": len(profile)}
+        event.set_results(results)
+
+    def _update_status(self, _):
+        """Set the unit status once the workload has served its first scrape.
+
+        Until kube-state-metrics has finished listing the watched objects, it
+        serves empty or partial metrics, so the unit stays in maintenance and the
+        time it took to become ready is recorded once it does.
+        """
+        if not self._validate_config() or not self._check_shard():
+            return
+        if not self.unit.get_container("kube-state-metrics").can_connect():
+            self.unit.status = WaitingStatus("Waiting for Pebble")
+            return
+        if self._stored.started_at is not None:
+            if not self._workload_ready():
+                self.unit.status = MaintenanceStatus(
+                    "Waiting for kube-state-metrics to be ready"
+                )
+                return
+            self._stored.ready_after = time.time() - self._stored.started_at
+            self._stored.started_at = None
+            self._release_restart_lock()
+            logger.info(
+                "kube-state-metrics served its first scrape after %.1fs",
+                self._stored.ready_after,
+            )
+
+        if self._stored.over_budget:
+            self.unit.status = BlockedStatus(self._stored.over_budget)
+            return
+
+        message = []
+        if self.partition is not None:
+            message.append(
+                "Partition {} of {}".format(*self.shard)
+                + f" ({len(self.partition)} resources)"
+            )
+        elif self.shard is not None:
+            message.append("Shard {} of {}".format(*self.shard))
+        elif self.config["sharding"] == "statefulset":
+            message.append("Sharded by StatefulSet")
+        if self.tiers:
+            message.append(f"{len(self.tiers) + 1} scrape tiers")
+        if (
+            self.config["scrape-interval"] == scrape_config.AUTO
+            and self.unit.is_leader()
+        ):
+            message.append(f"scraped every {self.scrape_settings['scrape-interval']}")
+        if self.config["active-standby"]:
+            message.append("scraped" if self.unit.is_leader() else "standby")
+        if self.config["use-apiserver-cache"]:
+            message.append("using apiserver cache")
+        if self._stored.ready_after is not None:
+            message.append(f"first scrape after {self._stored.ready_after:.1f}s")
+        probes = self._stored.scrape_probes.get("kube-state-metrics")
+        if probes:
+            _, seconds, size, series = probes[-1]
+            message.append(
+                f"scrape {seconds:.1f}s, {size / 2**20:.1f}MB, {series} series"
+            )
+        message.extend(self._slow_scrapes())
+        if self.workload_config.warnings:
+            message.append("costly config, see debug-log")
+        if self._stored.denied_families:
+            message.append(
+                f"{len(self._stored.denied_families)} families denied by max-series"
+            )
+        self.unit.status = ActiveStatus(", ".join(message))
+
+    def _workload_ready(self):
+        """Check whether kube-state-metrics is ready and serving metrics."""
+        urls = []
+        for service in self.services:
+            urls.append(READYZ_URL.format(port=service.telemetry_port))
+            urls.append(f"http://localhost:{service.port}/metrics")
+        for url in urls:
+            try:
+                # only the response status is needed, not the (large) metrics body
+                with urlopen(url, timeout=10):
+                    pass
+            except OSError as e:
+                logger.debug("kube-state-metrics not ready: %s: %s", url, e)
+                return False
+        return True
+
+    def _probe_scrapes(self):
+        """Time a scrape of each of this unit's processes, as Prometheus would.
+
+        The duration, body size and number of series of each scrape are kept, so
+        that trends show in the logs, and a scrape which gets close to its timeout
+        is reported in the unit status. Probing is opt-in, unless the series
+        budget or the automatic scrape interval needs it.
+
+        Returns:
+            A `Counter` of the series by metric family across the processes, or
+            None if the workload could not be probed.
+        """
+        needed = (
+            self.config["probe-scrapes"]
+            or self.config["max-series"]
+            or self.config["scrape-interval"] == scrape_config.AUTO
+        )
+        if not needed:
+            # parsing a large exposition takes long, so only probe when asked to
+            self._stored.scrape_probes = {}
+            return None
+        if not self._validate_config() or self._stored.started_at is not None:
+            # not serving the complete metrics yet
+            return None
+        counts = Counter()
+        for service in self.services:
+            url = f"http://localhost:{service.port}/metrics"
+            try:
+                start = time.perf_counter()
+                with urlopen(url, timeout=60) as response:
+                    connected = time.perf_counter() - start
+                    stream = exposition.MeteredStream(response)
+                    service_counts = exposition.series_per_family(stream)
+            except OSError as e:
+                logger.warning("Failed to probe %s: %s", url, e)
+                return None
+            counts.update(service_counts)
+            reading = [
+                time.time(),
+                connected + stream.seconds,
+                stream.bytes,
+                sum(service_counts.values()),
+            ]
+            # the earlier readings are copied out of their StoredList wrappers,
+            # which cannot be saved inside a plain list
+            history = [
+                *(list(r) for r in self._stored.scrape_probes.get(service.name, [])),
+                reading,
+            ]
+            self._stored.scrape_probes[service.name] = history[-PROBE_HISTORY:]
+            first = history[0]
+            logger.info(
+                "%s: scrape took %.2fs for %d bytes, %d series "
+                "(was %.2fs, %d bytes, %d series %.0fm ago)",
+                service.name,
+                *reading[1:],
+                *first[1:],
+                (reading[0] - first[0]) / 60,
+            )
+        return counts
+
+    @property
+    def _auto_scrape(self):
+        """The scrape interval and timeout chosen by the leader, if automatic.
+
+        The choice is kept in the peer relation, so that it outlives a change of
+        leader and all units agree on it.
+        """
+        relation = self.model.get_relation("cluster")
+        chosen = relation and relation.data[self.app].get("auto-scrape")
+        return tuple(int(seconds) for seconds in chosen.split(",")) if chosen else None
+
+    def _choose_scrape_interval(self):
+        """Choose the scrape interval from the latest probe, when it is automatic.
+
+        The leader republishes the scrape jobs whenever its choice changes.
+        """
+        relation = self.model.get_relation("cluster")
+        if relation is None or not self.unit.is_leader():
+            return
+        if self.config["scrape-interval"] != scrape_config.AUTO:
+            relation.data[self.app].pop("auto-scrape", None)
+            return
+        current = self._auto_scrape
+        seconds = self._stored.scrape_probes["kube-state-metrics"][-1][1]
+        chosen = scrape_config.auto_scrape(self.config, seconds, current)
+        if current == chosen:
+            return
+        logger.info(
+            "Scrape took %.2fs; scraping every %ds with a %ds timeout", seconds, *chosen
+        )
+        relation.data[self.app]["auto-scrape"] = ",".join(map(str, chosen))
+        self._publish_scrape_jobs()
+
+    def _publish_scrape_jobs(self):
+        """Publish the scrape jobs, keeping them for when the config is not valid."""
+        jobs = self.scrape_jobs
+        self._stored.scrape_jobs = json.dumps(jobs)
+        self.monitoring.update_scrape_job_spec(jobs)
+
+    def _slow_scrapes(self):
+        """Describe the latest probed scrapes which came close to their timeout."""
+        settings = self.scrape_settings
+        timeouts = {
+            "kube-state-metrics": scrape_config.scrape_timeout(
+                settings["scrape-timeout"], settings["scrape-interval"]
+            )
+        }
+        for tier in self.tiers:
+            timeouts[f"kube-state-metrics-{tier.name}"] = scrape_config.scrape_timeout(
+                "", tier.interval
+            )
+        slow = []
+        for name, timeout in timeouts.items():
+            history = self._stored.scrape_probes.get(name)
+            if history and history[-1][1] > SLOW_SCRAPE_RATIO * timeout:
+                slow.append(
+                    f"slow scrape of {name}: {history[-1][1]:.1f}s of {timeout:g}s"
+                )
+        return slow
+
+    def _check_series_budget(self, counts):
+        """Check the series served by this unit against the max-series budget.
+
+        When over budget, either blocks naming the worst families, or denies them
+        so that the remaining series fit the budget, returning True if the workload
+        needs to be re-rendered with the extended denylist.
+        """
+        budget = self.config["max-series"]
+        if not budget:
+            return False
+        total = sum(counts.values())
+        logger.debug("Serving %d series of %d families", total, len(counts))
+        if total <= budget:
+            self._stored.over_budget = None
+            return False
+        worst = counts.most_common()
+        if self.config["max-series-action"] == "deny" and (
+            not self.config["metric-allowlist"]
+        ):
+            denied = []
+            for family, count in worst:
+                if total <= budget:
+                    break
+                denied.append(family)
+                total -= count
+            logger.warning(
+                "Over max-series budget of %d; denying %s", budget, ", ".join(denied)
+            )
+            self._stored.denied_families = sorted(
+                {*self._stored.denied_families, *denied}
+            )
+            return True
+        top = ", ".join(f"{family} ({count})" for family, count in worst[:3])
+        self._stored.over_budget = f"{total} series exceeds max-series: {top}"
+        return False
+
+    def _reset_series_budget(self):
+        """Forget the result of the series budget check when the config changes.
+
+        The config may have changed which series are served, or the budget, so
+        the families denied to fit the budget are restored until the next check.
+        """
+        options = ("max-series", "max-series-action", *OPTIONS)
+        budget_config = hashlib.sha256(
+            str([self.config.get(option) for option in options]).encode()
+        ).hexdigest()
+        if self._stored.budget_config == budget_config:
+            return
+        self._stored.budget_config = budget_config
+        self._stored.denied_families = []
+        self._stored.over_budget = None
+
+    def _push_files(self, container):
+        """Push the config files for the workload into its container.
+
+        Each file is only pushed when its content changes, so that kube-state-metrics
+        only reloads it when needed.
+        """
+        files = {CUSTOM_RESOURCE_STATE_PATH: self.config["custom-resource-state"]}
+        for service in self.services:
+            files[service.config_file] = self._compile(service).config_file
+        for path, content in files.items():
+            if not content:
+                self._stored.pushed_hashes.pop(path, None)
+                continue
+            content_hash = hashlib.sha256(content.encode()).hexdigest()
+            if self._stored.pushed_hashes.get(
+                path
+            ) == content_hash and container.exists(path):
+                continue
+            container.push(path, content, make_dirs=True)
+            self._stored.pushed_hashes[path] = content_hash
+            logger.info("Pushed %s (%s)", path, content_hash[:12])
+
+    def _patch_resources(self):
+        """Set the configured requests and limits on the workload container.
+
+        Only the leader patches the application's StatefulSet, which then rolls
+        its pods; the patch is skipped entirely if resources were never configured.
+        """
+        requests, limits = compute_resources.resource_requirements(self.config)
+        if not self.unit.is_leader():
+            return True
+        if not (requests or limits or self._stored.resources_patched):
+            return True
+        try:
+            if compute_resources.patch_statefulset(
+                self.app.name, self.model.name, "kube-state-metrics", requests, limits
+            ):
+                logger.info(
+                    "Patched resources: requests=%s limits=%s", requests, limits
+                )
+        except ApiError as e:
+            logger.error("Failed to patch resources: %s", e)
+            self.unit.status = BlockedStatus(
+                "Failed to patch resources; is the application trusted?"
+            )
+            return False
+        self._stored.resources_patched = bool(requests or limits)
+        return True
+
+    def _disable_stale_services(self, container, layer):
+        """Stop and disable the processes and checks of scrape tiers which were removed.
+
+        Services and checks cannot be removed from the Pebble plan, so they are
+        disabled by a layer of their own, which is rewritten if their tier is added
+        back.
+        """
+        plan = container.get_plan()
+        stale_services, services = _stale_layer_items(plan.services, layer.services)
+        stale_checks, checks = _stale_layer_items(plan.checks, layer.checks)
+        if not services and not checks:
+            return
+        container.add_layer(
+            "kube-state-metrics-stale",
+            Layer({"services": services, "checks": checks}),
+            combine=True,
+        )
+        if stale_services:
+            container.stop(*stale_services)
+        if stale_checks:
+            container.stop_checks(*stale_checks)
+        readded_checks = [name for name in checks if name not in stale_checks]
+        if readded_checks:
+            container.start_checks(*readded_checks)
+
+    def _acquire_restart_lock(self):
+        """Request the rolling restart lock, returning whether this unit holds it.
+
+        The lock is held until the workload is ready again after the restart,
+        so that only one unit (and hence only one shard) is restarting at a time.
+        """
+        relation = self.model.get_relation("cluster")
+        if relation is None:
+            return True
+        relation.data[self.unit]["restart"] = "requested"
+        self._grant_restart_lock()
+        return relation.data[self.app].get("restart-granted") == self.unit.name
+
+    def _release_restart_lock(self):
+        """Withdraw this unit's request for the rolling restart lock, if any."""
+        relation = self.model.get_relation("cluster")
+        if relation is None or "restart" not in relation.data[self.unit]:
+            return
+        del relation.data[self.unit]["restart"]
+        self._grant_restart_lock()
+
+    def _grant_restart_lock(self):
+        """Grant the rolling restart lock to the next unit waiting for it.
+
+        Only the leader manages the lock, which it grants in unit number order
+        once the unit currently holding it has released it or departed.
+        """
+        relation = self.model.get_relation("cluster")
+        if relation is None or not self.unit.is_leader():
+            return
+        waiting = sorted(
+            (
+                unit
+                for unit in {self.unit, *relation.units}
+                if relation.data[unit].get("restart")
+            ),
+            key=lambda unit: int(unit.name.split("/")[-1]),
+        )
+        if relation.data[self.app].get("restart-granted") in {u.name for u in waiting}:
+            return
+        if waiting:
+            relation.data[self.app]["restart-granted"] = waiting[0].name
+        else:
+            relation.data[self.app].pop("restart-granted", None)
+
+    def _is_scraped(self):
+        """Whether Prometheus should scrape this unit.
+
+        In active/standby mode only the leader is scraped; the standby units keep
+        their caches warm so that they can take over on a change of leader.
+        """
+        return not self.config["active-standby"] or self.unit.is_leader()
+
+    def _publish_scraped_unit(self):
+        """Tell the other units which unit is scraped in active/standby mode.
+
+        The change to the peer relation data lets a unit which has lost the
+        leadership withdraw its scrape address, which it would not otherwise
+        notice until its next hook.
+        """
+        relation = self.model.get_relation("cluster")
+        if relation is None or not self.unit.is_leader():
+            return
+        if self.config["active-standby"]:
+            relation.data[self.app]["scraped-unit"] = self.unit.name
+        else:
+            relation.data[self.app].pop("scraped-unit", None)
 
     def _validate_config(self):
         """Check that charm config settings are valid.
@@ -69,13 +684,180 @@ class KubeStateMetricsOperator(CharmBase):
         If the charm config is not valid, will set the unit status to BlockedStatus and
         return False.
         """
-        if self.config["metric-allowlist"] and self.config["metric-denylist"]:
+        try:
+            scrape_config.validate(self.config)
+            compute_resources.resource_requirements(self.config)
+            for service in self.services:
+                self._compile(service)
+        except ConfigError as e:
+            self.unit.status = BlockedStatus(str(e))
+            return False
+        if self.config["sharding"] not in SHARDING_MODES:
+            self.unit.status = BlockedStatus(
+                f"sharding must be one of: {', '.join(SHARDING_MODES)}"
+            )
+            return False
+        try:
+            weights = parse_weights(self.config["resource-weights"])
+        except ValueError as e:
+            self.unit.status = BlockedStatus(f"resource-weights: {e}")
+            return False
+        if self.config["max-series-action"] not in MAX_SERIES_ACTIONS:
+            self.unit.status = BlockedStatus(
+                f"max-series-action must be one of: {', '.join(MAX_SERIES_ACTIONS)}"
+            )
+            return False
+        if self.config["max-series"] < 0:
+            self.unit.status = BlockedStatus("max-series must not be negative")
+            return False
+        if self.config["active-standby"] and self.config["sharding"] != "none":
+            self.unit.status = BlockedStatus(
+                "active-standby cannot be combined with sharding"
+            )
+            return False
+        if self.tiers and self.config["sharding"] == "resources":
+            self.unit.status = BlockedStatus(
+                "scrape-tiers cannot be combined with sharding by resources"
+            )
+            return False
+        if self.tiers and not self.services[0].resources:
+            self.unit.status = BlockedStatus(
+                "scrape-tiers must leave some resources for scrape-interval"
+            )
+            return False
+        unknown = sorted(set(weights) - set(self.resources))
+        if unknown:
+            self.unit.status = BlockedStatus(
+                f"resource-weights: unknown resources: {', '.join(unknown)}"
+            )
+            return False
+        return True
+
+    def _check_shard(self):
+        """Check that this unit has a share of the work when sharding.
+
+        If it does not, will set the unit status accordingly and return False.
+        """
+        if self.shard is not None and self.shard[0] >= self.shard[1]:
+            # this unit is being removed as part of a scale down
+            self.unit.status = WaitingStatus("Waiting for scale down")
+            return False
+        if self.partition == []:
             self.unit.status = BlockedStatus(
-                "metric-allowlist and metric-denylist are mutually exclusive"
+                "More units than resources to partition; scale down"
             )
             return False
         return True
 
+    @property
+    def resources(self):
+        """Resources to be monitored across all units."""
+        resources = [
+            r.strip() for r in self.config["resources"].split(",") if r.strip()
+        ]
+        return resources or list(DEFAULT_RESOURCES)
+
+    @property
+    def tiers(self):
+        """Scrape tiers, each run as a separate kube-state-metrics process."""
+        try:
+            return scrape_config.parse_tiers(self.config["scrape-tiers"])
+        except ConfigError:
+            return []
+
+    @property
+    def services(self):
+        """The kube-state-metrics processes to run, the main process first."""
+        resources = None
+        if self.partition is not None:
+            resources = tuple(self.partition)
+        elif self.tiers:
+            tiered = {r for tier in self.tiers for r in tier.resources}
+            resources = tuple(r for r in self.resources if r not in tiered)
+        services = [
+            WorkloadService(
+                "kube-state-metrics", 8080, 8081, resources, CONFIG_FILE_PATH
+            )
+        ]
+        for tier in self.tiers:
+            services.append(
+                WorkloadService(
+                    f"kube-state-metrics-{tier.name}",
+                    tier.port,
+                    tier.telemetry_port,
+                    tier.resources,
+                    f"{CONFIG_DIR}/config-{tier.name}.yaml",
+                )
+            )
+        return services
+
+    @property
+    def shard(self):
+        """Shard index and total shards for this unit, or None if not sharding.
+
+        The shard index is the unit number, which matches the ordinal of the
+        unit's pod in the application's StatefulSet, and the total is the
+        number of units the application is planned to have.
+        """
+        if self.config["sharding"] not in ("units", "resources"):
+            return None
+        ordinal = int(self.unit.name.split("/")[-1])
+        return ordinal, self.app.planned_units()
+
+    @property
+    def partition(self):
+        """Resources monitored by this unit, or None if not partitioning resources."""
+        if self.config["sharding"] != "resources":
+            return None
+        index, total = self.shard
+        if index >= total:
+            return None
+        weights = {
+            **DEFAULT_WEIGHTS,
+            **parse_weights(self.config["resource-weights"]),
+        }
+        return partition_resources(self.resources, weights, total)[index]
+
+    @property
+    def pod_name(self):
+        """Name of the pod this unit is running in."""
+        return self.unit.name.replace("/", "-")
+
+    @property
+    def scrape_settings(self):
+        """The charm config, with the scrape interval and timeout chosen if automatic."""
+        settings = dict(self.config)
+        if settings["scrape-interval"] == scrape_config.AUTO:
+            try:
+                interval, timeout = scrape_config.auto_scrape(
+                    self.config, current=self._auto_scrape
+                )
+            except ConfigError:
+                # the unit is blocked until the config is fixed, but the settings
+                # must still be valid durations
+                settings["scrape-interval"] = scrape_config.DEFAULT_SCRAPE_INTERVAL
+                settings["scrape-timeout"] = ""
+                return settings
+            settings["scrape-interval"] = f"{interval}s"
+            settings["scrape-timeout"] = f"{timeout}s"
+        return settings
+
+    @property
+    def scrape_jobs(self):
+        """Prometheus scrape jobs for the workload endpoints.
+
+        The jobs are also published by the relation events of the provider, which
+        don't check the config, so while the scrape settings are not valid the last
+        published jobs are kept, or default ones if none were published yet.
+        """
+        try:
+            scrape_config.validate(self.config)
+        except ConfigError:
+            if self._stored.scrape_jobs:
+                return json.loads(self._stored.scrape_jobs)
+            return scrape_config.default_jobs()
+        return scrape_config.scrape_jobs(self.scrape_settings, self.tiers)
+
     @property
     def monitoring_address(self):
         binding = self.model.get_binding("metrics-endpoint")
@@ -83,32 +865,108 @@ class KubeStateMetricsOperator(CharmBase):
             return None
         return str(binding.network.ingress_address or binding.network.bind_address)
 
+    @property
+    def workload_config(self):
+        """Workload flags for the main process, compiled from the charm config.
+
+        Raises:
+            ConfigError: if the charm config is not valid.
+        """
+        return self._compile(self.services[0])
+
+    def _compile(self, service):
+        """Compile the charm config into the flags for a kube-state-metrics process."""
+        options = dict(self.config)
+        # families are only denied to fit the budget without an allowlist
+        if self._stored.denied_families and not self.config["metric-allowlist"]:
+            options["metric-denylist"] = ",".join(
+                filter(
+                    None,
+                    [self.config["metric-denylist"], *self._stored.denied_families],
+                )
+            )
+        if service.resources is not None:
+            options["resources"] = ",".join(service.resources)
+        if not self._serves_custom_resources(service):
+            options["custom-resource-state"] = ""
+        config_file = service.config_file if self.config["hot-reload"] else None
+        return compile_config(options, config_file=config_file)
+
+    def _serves_custom_resources(self, service):
+        """Whether a process serves the metrics of the custom resource state config.
+
+        Custom resources are neither tiered nor partitioned, so only the main
+        process of the first partition serves them, to not duplicate their series.
+        """
+        if service.name != self.services[0].name:
+            return False
+        return self.config["sharding"] != "resources" or self.shard[0] == 0
+
     @property
     def layer(self):
         """Pebble layer for workload."""
-        layer_args = list(self.config.keys())
-        layer_args.remove("scrape-interval")
+        shared_args = []
+        environment = {}
+        if self.config["sharding"] == "units":
+            shared_args += [f"--shard={self.shard[0]}"]
+            shared_args += [f"--total-shards={self.shard[1]}"]
+        elif self.config["sharding"] == "statefulset":
+            # Pebble does not expand variables in the command, so the values are
+            # rendered into the flags as well as exposed in the environment
+            environment = {"POD_NAME": self.pod_name, "POD_NAMESPACE": self.model.name}
+            shared_args += [
+                f"--pod={self.pod_name}",
+                f"--pod-namespace={self.model.name}",
+            ]
+        _, limits = compute_resources.resource_requirements(self.config)
+        environment.update(compute_resources.go_runtime_environment(limits))
+        crs_environment = dict(environment)
+        crs = self.config["custom-resource-state"]
+        if crs and not self.config["hot-reload"]:
+            # restart kube-state-metrics when the content of its config changes,
+            # unless it has been asked to reload its config files
+            crs_environment["CUSTOM_RESOURCE_STATE_SHA256"] = hashlib.sha256(
+                crs.encode()
+            ).hexdigest()
+        services = {}
+        checks = {}
+        for service in self.services:
+            checks[f"{service.name}-alive"] = {
+                "override": "replace",
+                "level": "alive",
+                "http": {"url": HEALTHZ_URL.format(port=service.port)},
+            }
+            checks[f"{service.name}-ready"] = {
+                "override": "replace",
+                "level": "ready",
+                # fail fast, so that recovery signals readiness after a restart
+                "threshold": 1,
+                "http": {"url": READYZ_URL.format(port=service.telemetry_port)},
+            }
+            args = [
+                "/kube-state-metrics",
+                f"--port={service.port}",
+                f"--telemetry-port={service.telemetry_port}",
+                *shared_args,
+                *self._compile(service).flags,
+            ]
+            services[service.name] = {
+                "override": "replace",
+                "summary": service.name,
+                "command": shlex.join(args),
+                "startup": "enabled",
+                "environment": (
+                    crs_environment
+                    if self._serves_custom_resources(service)
+                    else environment
+                ),
+            }
         return Layer(
             {
                 "summary": "kube-state-metrics layer",
                 "description": "pebble config layer for kube-state-metrics",
-                "services": {
-                    "kube-state-metrics": {
-                        "override": "replace",
-                        "summary": "kube-state-metrics",
-                        "command": (
-                            "/kube-state-metrics --port=8080 --telemetry-port=8081 "
-                            + " ".join(
-                                [
-                                    f"--{key}=value"
-                                    for key, value in self.config.items()
-                                    if value and key in layer_args
-                                ]
-                            )
-                        ),
-                        "startup": "enabled",
-                    }
-                },
+                "services": services,
+                "checks": checks,
             }
         )
 
@@ -0,0 +1,120 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+"""Compute resource requests and limits for the workload container."""
+
+import math
+import re
+
+from lightkube import Client
+from lightkube.resources.apps_v1 import StatefulSet
+from lightkube.utils.quantity import equals_canonically
+
+from workload_config import ConfigError
+
+_QUANTITY = re.compile(r"^(\d+(?:\.\d+)?)(m|k|M|G|T|P|E|Ki|Mi|Gi|Ti|Pi|Ei)?$")
+_SUFFIXES = {
+    None: 1,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+}
+
+# fraction of the memory limit given to the Go runtime as its soft limit, leaving
+# headroom for memory not managed by the Go runtime before the container is OOM-killed
+GOMEMLIMIT_RATIO = 0.9
+
+
+def parse_quantity(option, value):
+    """Parse a Kubernetes resource quantity (e.g. '500m' or '1Gi') into a number.
+
+    Raises:
+        ConfigError: if the value is not a valid quantity.
+    """
+    match = _QUANTITY.match(value)
+    if not match:
+        raise ConfigError(f"{option}: invalid quantity {value!r}")
+    return float(match.group(1)) * _SUFFIXES[match.group(2)]
+
+
+def resource_requirements(config):
+    """Get the requests and limits for the workload container from the charm config.
+
+    Raises:
+        ConfigError: if a quantity is invalid, or a request exceeds its limit.
+    """
+    requests, limits = {}, {}
+    for resource in ("cpu", "memory"):
+        quantities = {}
+        for kind, found in (("request", requests), ("limit", limits)):
+            option = f"{resource}-{kind}"
+            if config[option]:
+                quantities[kind] = parse_quantity(option, config[option])
+                found[resource] = config[option]
+        if quantities.get("request", 0) > quantities.get("limit", math.inf):
+            raise ConfigError(f"{resource}-request must not exceed {resource}-limit")
+    return requests, limits
+
+
+def go_runtime_environment(limits):
+    """Go runtime settings which keep the workload within its container limits.
+
+    Without these, the Go runtime sizes GOMAXPROCS to the node's cores rather than
+    the CPU quota and lets the heap grow until the container is OOM-killed.
+    """
+    environment = {}
+    if "memory" in limits:
+        memory = parse_quantity("memory-limit", limits["memory"])
+        environment["GOMEMLIMIT"] = str(int(memory * GOMEMLIMIT_RATIO))
+    if "cpu" in limits:
+        cpu = parse_quantity("cpu-limit", limits["cpu"])
+        environment["GOMAXPROCS"] = str(max(1, math.ceil(cpu)))
+    return environment
+
+
+def patch_statefulset(app_name, namespace, container, requests, limits):
+    """Patch the requests and limits of a container in the application's StatefulSet.
+
+    Returns:
+        Whether the StatefulSet was changed, which rolls its pods.
+
+    Raises:
+        lightkube.ApiError: if the StatefulSet could not be read or patched.
+    """
+    client = Client(field_manager=app_name)
+    statefulset = client.get(StatefulSet, app_name, namespace=namespace)
+    current = next(
+        c.resources
+        for c in statefulset.spec.template.spec.containers
+        if c.name == container
+    )
+    # the API server normalizes the quantities (e.g. '0.5' to '500m'), so they are
+    # compared by value rather than as configured
+    if equals_canonically(current.requests or {}, requests) and equals_canonically(
+        current.limits or {}, limits
+    ):
+        return False
+    # strategic merge deletes the keys set to None, i.e. those no longer configured
+    resources = {
+        "requests": {r: requests.get(r) for r in ("cpu", "memory")},
+        "limits": {r: limits.get(r) for r in ("cpu", "memory")},
+    }
+    patch = {
+        "spec": {
+            "template": {
+                "spec": {"containers": [{"name": container, "resources": resources}]}
+            }
+        }
+    }
+    client.patch(StatefulSet, app_name, patch, namespace=namespace)
+    return True
@@ -0,0 +1,287 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+"""Streaming parser for the Prometheus text exposition served by kube-state-metrics.
+
+The exposition of a large cluster can be hundreds of MB, so it is read in chunks
+and parsed into the metadata and samples of each family as it is streamed. The
+samples are yielded as tuples of the raw bytes of each part of the line, and the
+labels are only parsed when asked for, so that no per-sample dicts are built.
+Totals are kept per family, with the distinct values of each label counted
+exactly up to a threshold and estimated in fixed memory beyond it.
+"""
+
+import math
+import re
+import sys
+import time
+from collections import Counter
+from typing import NamedTuple
+
+# size of the chunks in which a stream is read
+CHUNK_SIZE = 1 << 20
+
+_LABEL = re.compile(rb'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+class Metadata(NamedTuple):
+    """A HELP or TYPE line of a metric family."""
+
+    family: bytes
+    keyword: bytes
+    text: bytes
+
+
+class Sample(NamedTuple):
+    """A sample line, with the raw bytes of its parts."""
+
+    family: bytes
+    name: bytes
+    # the text between the braces, which can be parsed with `labels`
+    labels: bytes
+    # the value, followed by the timestamp if there is one
+    value: bytes
+    # the length of the line, including its newline
+    size: int
+
+
+class LabelCardinality:
+    """Counter of the distinct values of a label, in bounded memory.
+
+    The hashes of the values are kept exactly up to `EXACT_LIMIT` values, after
+    which they are folded into a HyperLogLog sketch with a standard error of
+    about 1.6%, which takes a few KB however many values there are.
+    """
+
+    __slots__ = ("_hashes", "_registers")
+
+    EXACT_LIMIT = 1024
+    # the sketch has 2**PRECISION one byte registers
+    PRECISION = 12
+
+    def __init__(self):
+        self._hashes = set()
+        self._registers = None
+
+    def add(self, value):
+        """Count a value of the label."""
+        if self._registers is None:
+            self._hashes.add(hash(value))
+            if len(self._hashes) > self.EXACT_LIMIT:
+                self._registers = bytearray(1 << self.PRECISION)
+                for h in self._hashes:
+                    self._add_hash(h)
+                self._hashes = None
+        else:
+            self._add_hash(hash(value))
+
+    def _add_hash(self, h):
+        h &= 0xFFFFFFFFFFFFFFFF
+        index = h >> (64 - self.PRECISION)
+        rest = (h << self.PRECISION) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.PRECISION + 1 if not rest else 65 - rest.bit_length()
+        self._registers[index] = max(self._registers[index], rank)
+
+    def __len__(self):
+        if self._registers is None:
+            return len(self._hashes)
+        m = len(self._registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m
+        estimate /= sum(2.0**-r for r in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class FamilyStats:
+    """Totals for the series of a metric family."""
+
+    __slots__ = ("bytes", "label_values", "namespaces", "series")
+
+    def __init__(self):
+        self.series = 0
+        self.bytes = 0
+        # `LabelCardinality` of each label of the family
+        self.label_values = {}
+        self.namespaces = Counter()
+
+    @property
+    def cardinality(self):
+        """The label with the most distinct values, and its number of values."""
+        if not self.label_values:
+            return None, 0
+        counts = {label: len(values) for label, values in self.label_values.items()}
+        label = max(counts, key=counts.get)
+        return label, counts[label]
+
+
+class MeteredStream:
+    """Wrapper of a binary file-like object, metering what is read from it.
+
+    Only the time spent reading is metered, not the time spent parsing what is
+    read, so that it reflects how long the exposition takes to serve.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self._stream.read(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+
+def lines(stream, chunk_size=CHUNK_SIZE):
+    """Split a stream into lines, without their newlines.
+
+    Args:
+        stream: a binary file-like object, which is read in chunks, or an
+            iterable of the lines of the exposition, as bytes.
+        chunk_size: the size of the chunks in which a file-like object is read.
+    """
+    if not hasattr(stream, "read"):
+        for line in stream:
+            yield line.rstrip(b"\n")
+        return
+    tail = b""
+    while chunk := stream.read(chunk_size):
+        chunk_lines = (tail + chunk).split(b"\n")
+        tail = chunk_lines.pop()
+        yield from chunk_lines
+    if tail:
+        yield tail
+
+
+def _family(name, family):
+    """Get the family of a sample, given the family of the preceding metadata."""
+    if family and (name == family or name.startswith(family + b"_")):
+        return family
+    return name
+
+
+def parse(stream, chunk_size=CHUNK_SIZE):
+    """Parse a text exposition, yielding its `Metadata` and `Sample` lines.
+
+    Samples belong to the family of the preceding metadata if their name is that
+    of the family, possibly with a suffix (e.g. `_bucket`), or else to a family of
+    their own name. Comments and blank lines are skipped.
+
+    Args:
+        stream: a binary file-like object or an iterable of lines, see `lines`.
+        chunk_size: the size of the chunks in which a file-like object is read.
+    """
+    family = None
+    for line in lines(stream, chunk_size):
+        if line.startswith(b"#"):
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] in (b"HELP", b"TYPE"):
+                family = parts[2]
+                text = parts[3].rstrip() if len(parts) > 3 else b""
+                yield Metadata(family, parts[1], text)
+            continue
+        name, brace, rest = line.partition(b"{")
+        if brace:
+            labels, _, value = rest.rpartition(b"}")
+        else:
+            name, _, value = name.strip().partition(b" ")
+            labels = b""
+        name = name.strip()
+        if not name:
+            continue
+        family = _family(name, family)
+        yield Sample(family, name, labels, value.strip(), len(line) + 1)
+
+
+def labels(sample):
+    """Yield the name and raw value of each label of a sample, as bytes."""
+    yield from _LABEL.findall(sample.labels)
+
+
+def series_per_family(stream):
+    """Count the series of each metric family in a text exposition.
+
+    Returns:
+        A `Counter` of the number of series by metric family name.
+    """
+    counts = Counter()
+    for item in parse(stream):
+        if type(item) is Sample:
+            counts[item.family] += 1
+    return Counter({family.decode(): count for family, count in counts.items()})
+
+
+def family_stats(stream, stats=None):
+    """Collect the series, size and label cardinality of each metric family.
+
+    Args:
+        stream: a binary file-like object or an iterable of lines, see `lines`.
+        stats: optional dict of `FamilyStats` by family name to add to, so that
+            the expositions of several endpoints can be combined.
+
+    Returns:
+        A dict of `FamilyStats` by metric family name.
+    """
+    stats = {} if stats is None else stats
+    # the label names and namespaces are decoded once, rather than for every sample
+    names = {}
+    current, family_stats = None, None
+    for item in parse(stream):
+        if type(item) is not Sample:
+            continue
+        if item.family != current:
+            current = item.family
+            family = sys.intern(current.decode())
+            family_stats = stats.get(family)
+            if family_stats is None:
+                family_stats = stats[family] = FamilyStats()
+        family_stats.series += 1
+        family_stats.bytes += item.size
+        label_values = family_stats.label_values
+        for label, value in _LABEL.findall(item.labels):
+            label = names.get(label) or names.setdefault(label, label.decode())
+            if label == "namespace":
+                value = names.get(value) or names.setdefault(value, value.decode())
+                family_stats.namespaces[value] += 1
+            values = label_values.get(label)
+            if values is None:
+                values = label_values[label] = LabelCardinality()
+            values.add(value)
+    return stats
+
+
+def report(stats, top=10):
+    """Summarize the largest metric families by series, label cardinality and size.
+
+    Returns:
+        A dict of text with a line per family, for each of the rankings.
+    """
+
+    def namespaces(family):
+        counts = stats[family].namespaces.most_common(3)
+        if not counts:
+            return ""
+        return " (" + ", ".join(f"{ns}: {count}" for ns, count in counts) + ")"
+
+    cardinality = {
+        family: family_stats.cardinality for family, family_stats in stats.items()
+    }
+    by_series = sorted(stats, key=lambda f: stats[f].series, reverse=True)[:top]
+    by_cardinality = sorted(stats, key=lambda f: cardinality[f][1], reverse=True)[:top]
+    by_bytes = sorted(stats, key=lambda f: stats[f].bytes, reverse=True)[:top]
+    return {
+        "by-series": "\n".join(
+            f"{f}: {stats[f].series} series{namespaces(f)}" for f in by_series
+        ),
+        "by-label-cardinality": "\n".join(
+            "{}: {} has {} values".format(f, *cardinality[f])
+            for f in by_cardinality
+            if cardinality[f][0]
+        ),
+        "by-bytes": "\n".join(f"{f}: {stats[f].bytes} bytes" for f in by_bytes),
+    }
@@ -0,0 +1,63 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+"""Provider of the metrics-endpoint relation, extending the prometheus_scrape library.
+
+The library is vendored from Charmhub and is not edited, so that fetching a
+newer version of it doesn't lose these extensions. Extensions which upstream
+provides (e.g. `update_scrape_job_spec`) can be dropped once it is fetched.
+"""
+
+from charms.prometheus_k8s.v0 import prometheus_scrape
+
+# scrape job keys which the vendored library strips, or only allows misspelt
+EXTRA_KEYS = {"metric_relabel_configs", "label_value_length_limit", "body_size_limit"}
+
+
+def sanitize_scrape_configuration(job):
+    """Restrict a scrape job to the keys allowed by the library, and `EXTRA_KEYS`."""
+    allowed = prometheus_scrape.ALLOWED_KEYS | EXTRA_KEYS
+    sanitized_job = prometheus_scrape.DEFAULT_JOB.copy()
+    sanitized_job.update({key: value for key, value in job.items() if key in allowed})
+    return sanitized_job
+
+
+class MetricsEndpointProvider(prometheus_scrape.MetricsEndpointProvider):
+    """A `MetricsEndpointProvider` which can withdraw units and update its jobs."""
+
+    def __init__(self, charm, *args, jobs=None, is_scraped=None, **kwargs):
+        """Construct a metrics provider.
+
+        Args:
+            charm: the charm providing the metrics endpoint.
+            jobs: the Prometheus scrape jobs, see `update_scrape_job_spec`.
+            is_scraped: an optional callable returning whether this unit should
+                be scraped. Units for which it returns False withdraw their
+                address from the relation data, so that Prometheus does not
+                scrape them (e.g. the standby units of an active/standby
+                application). By default, every unit is scraped.
+            *args: further arguments of the library's provider.
+            **kwargs: further keyword arguments of the library's provider.
+        """
+        super().__init__(charm, *args, **kwargs)
+        self._is_scraped = is_scraped
+        self._jobs = [sanitize_scrape_configuration(job) for job in jobs or []]
+
+    def update_scrape_job_spec(self, jobs):
+        """Update the scrape job specification and re-publish it.
+
+        Args:
+            jobs: a list of dictionaries, each representing the Prometheus
+                scrape configuration for a single job.
+        """
+        self._jobs = [sanitize_scrape_configuration(job) for job in jobs]
+        self._set_scrape_job_spec(None)
+
+    def _set_unit_ip(self, event):
+        """Publish this unit's address, or withdraw it if it is not to be scraped."""
+        if self._is_scraped is None or self._is_scraped():
+            super()._set_unit_ip(event)
+            return
+        for relation in self._charm.model.relations[self._relation_name]:
+            relation.data[self._charm.unit].pop("prometheus_scrape_unit_address", None)
+            relation.data[self._charm.unit].pop("prometheus_scrape_unit_name", None)
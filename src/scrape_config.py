@@ -0,0 +1,283 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+"""Prometheus scrape jobs for the kube-state-metrics endpoints."""
+
+import math
+import re
+from typing import NamedTuple
+
+from workload_config import ConfigError
+
+_DURATION = re.compile(r"^((?P<h>\d+)h)?((?P<m>\d+)m)?((?P<s>\d+)s)?((?P<ms>\d+)ms)?$")
+
+
+_SIZE = re.compile(r"^\d+(B|KB|MB|GB|TB|PB|EB)$")
+_TIER_NAME = re.compile(r"^[a-z][a-z0-9]*$")
+_LABEL_NAME = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+_DROP_LABELS_ITEM = re.compile(
+    r"\s*(?:([a-zA-Z_:][a-zA-Z0-9_:]*)=\[([^\]]*)\]|([^,]*))\s*(,|$)"
+)
+
+# Prometheus' default scrape timeout, for jobs which don't set their own
+DEFAULT_SCRAPE_TIMEOUT = 10
+
+# interval of the jobs published while the scrape settings are not valid
+DEFAULT_SCRAPE_INTERVAL = "1m"
+
+# value of scrape-interval choosing the interval from the measured scrape cost
+AUTO = "auto"
+# the chosen interval only changes when the ideal one differs by more than this
+# factor, so that noise in the measurements doesn't keep republishing the jobs
+AUTO_HYSTERESIS = 1.25
+# the chosen timeout allows for scrapes this many times slower than measured
+AUTO_TIMEOUT_MARGIN = 3
+
+# ports for the kube-state-metrics processes of scrape tiers, two per tier
+TIER_BASE_PORT = 8090
+
+
+class Tier(NamedTuple):
+    """A kube-state-metrics process for a subset of resources with its own interval."""
+
+    name: str
+    interval: str
+    resources: tuple[str, ...]
+    port: int
+    telemetry_port: int
+
+
+def parse_duration(value):
+    """Parse a Prometheus duration (e.g. '1m30s') into seconds.
+
+    Raises:
+        ConfigError: if the value is not a valid duration.
+    """
+    match = _DURATION.match(value) if value else None
+    if not match or not any(match.groupdict().values()):
+        raise ConfigError(f"invalid duration: {value!r}")
+    parts = {k: int(v or 0) for k, v in match.groupdict().items()}
+    return parts["h"] * 3600 + parts["m"] * 60 + parts["s"] + parts["ms"] / 1000
+
+
+def scrape_timeout(timeout, interval):
+    """Get the effective timeout in seconds of a job's scrapes.
+
+    Args:
+        timeout: the job's scrape timeout, if any, as a duration.
+        interval: the job's scrape interval, as a duration.
+    """
+    if timeout:
+        return parse_duration(timeout)
+    return min(DEFAULT_SCRAPE_TIMEOUT, parse_duration(interval))
+
+
+def auto_scrape(config, seconds=None, current=None):
+    """Choose the scrape interval and timeout for the measured cost of a scrape.
+
+    The interval is the one at which scraping takes the target duty cycle of
+    the exporter's time, within the configured band, and the timeout leaves a
+    margin over the measured duration. Without a measurement, the interval is
+    the longest of the band.
+
+    Args:
+        config: the charm config.
+        seconds: the measured duration of a scrape, if any.
+        current: the interval and timeout in seconds currently chosen, if any,
+            which are kept while they remain close enough to the ideal ones.
+
+    Returns:
+        The interval and timeout in seconds.
+    """
+    low = parse_duration(config["auto-scrape-interval-min"])
+    high = math.ceil(parse_duration(config["auto-scrape-interval-max"]))
+    if seconds is None:
+        if current and low <= current[0] <= high:
+            return tuple(current)
+        return high, high
+    ideal = min(max(seconds / config["auto-scrape-duty-cycle"], low), high)
+    keep = (
+        current
+        and low <= current[0] <= high
+        and current[1] > seconds
+        and 1 / AUTO_HYSTERESIS <= ideal / current[0] <= AUTO_HYSTERESIS
+    )
+    if keep:
+        return tuple(current)
+    interval = math.ceil(ideal)
+    timeout = min(
+        interval, max(DEFAULT_SCRAPE_TIMEOUT, math.ceil(AUTO_TIMEOUT_MARGIN * seconds))
+    )
+    return interval, timeout
+
+
+def parse_tiers(value):
+    """Parse a `name:interval:resource,...;...` list of scrape tiers.
+
+    Raises:
+        ConfigError: if the value is malformed, or a name or resource is repeated.
+    """
+    tiers = []
+    seen = set()
+    for item in filter(None, (item.strip() for item in value.split(";"))):
+        try:
+            name, interval, resources = (part.strip() for part in item.split(":"))
+        except ValueError:
+            raise ConfigError(f"scrape-tiers: invalid tier {item!r}") from None
+        if not _TIER_NAME.match(name) or name in {t.name for t in tiers}:
+            raise ConfigError(f"scrape-tiers: invalid or repeated name {name!r}")
+        parse_duration(interval)
+        resources = tuple(r.strip() for r in resources.split(",") if r.strip())
+        if not resources or seen.intersection(resources):
+            raise ConfigError(f"scrape-tiers: missing or repeated resources in {name}")
+        seen.update(resources)
+        port = TIER_BASE_PORT + 2 * len(tiers)
+        tiers.append(Tier(name, interval, resources, port, port + 1))
+    return tiers
+
+
+def parse_drop_labels(value):
+    """Parse a `label,...,family=[label,...],...` list of labels to drop.
+
+    Returns:
+        A dict of the labels to drop by metric family, with the labels to drop
+        from every family under None.
+
+    Raises:
+        ConfigError: if the value is malformed or a label name is invalid.
+    """
+    drop = {}
+    pos = 0
+    while pos < len(value):
+        match = _DROP_LABELS_ITEM.match(value, pos)
+        family, labels, label = match.group(1), match.group(2), match.group(3)
+        labels = [label] if family is None else labels.split(",")
+        for label in filter(None, (label.strip() for label in labels)):
+            if not _LABEL_NAME.match(label) or label.startswith("__"):
+                raise ConfigError(f"drop-labels: invalid label {label!r}")
+            drop.setdefault(family, []).append(label)
+        pos = match.end()
+    return drop
+
+
+def metric_relabel_configs(value):
+    """Build the relabel configs which drop labels from the scraped samples.
+
+    Labels dropped from every family are removed with a single labeldrop rule;
+    labels dropped from one family are removed by setting them to an empty value
+    on that family's samples only.
+    """
+    drop = parse_drop_labels(value)
+    configs = []
+    if None in drop:
+        pattern = "|".join(dict.fromkeys(drop.pop(None)))
+        configs.append({"action": "labeldrop", "regex": pattern})
+    for family, labels in drop.items():
+        for label in dict.fromkeys(labels):
+            configs.append(
+                {
+                    "source_labels": ["__name__"],
+                    "regex": family,
+                    "target_label": label,
+                    "replacement": "",
+                }
+            )
+    return configs
+
+
+# charm config options for the limits of the state metrics jobs
+STATE_LIMITS = {
+    "sample-limit": "sample_limit",
+    "label-limit": "label_limit",
+    "label-name-length-limit": "label_name_length_limit",
+    "label-value-length-limit": "label_value_length_limit",
+    "body-size-limit": "body_size_limit",
+}
+
+
+def _job(name, ports, interval, **options):
+    job = {
+        "job_name": name,
+        "scrape_interval": interval,
+        "static_configs": [{"targets": [f"*:{port}" for port in ports]}],
+    }
+    job.update({key: value for key, value in options.items() if value})
+    return job
+
+
+def scrape_jobs(config, tiers=()):
+    """Build the scrape jobs for the state metrics and telemetry endpoints.
+
+    The large object state endpoint and the small self-telemetry endpoint are
+    separate jobs, so that each can have its own interval, timeout and limits.
+    Each scrape tier has a state metrics job of its own, with the tier's interval.
+    """
+    limits = {key: config[option] for option, key in STATE_LIMITS.items()}
+    limits["metric_relabel_configs"] = metric_relabel_configs(config["drop-labels"])
+    jobs = [
+        _job(
+            "kube-state-metrics",
+            [8080],
+            config["scrape-interval"],
+            scrape_timeout=config["scrape-timeout"],
+            **limits,
+        )
+    ]
+    for tier in tiers:
+        jobs.append(
+            _job(
+                f"kube-state-metrics-{tier.name}", [tier.port], tier.interval, **limits
+            )
+        )
+    jobs.append(
+        _job(
+            "telemetry",
+            [8081] + [tier.telemetry_port for tier in tiers],
+            config["telemetry-scrape-interval"],
+            scrape_timeout=config["telemetry-scrape-timeout"],
+            sample_limit=config["telemetry-sample-limit"],
+        )
+    )
+    return jobs
+
+
+def default_jobs():
+    """Build the scrape jobs for the default settings, without limits or tiers."""
+    return [
+        _job("kube-state-metrics", [8080], DEFAULT_SCRAPE_INTERVAL),
+        _job("telemetry", [8081], DEFAULT_SCRAPE_INTERVAL),
+    ]
+
+
+def validate(config):
+    """Check the scrape settings in the charm config.
+
+    Raises:
+        ConfigError: if any of the settings is not valid.
+    """
+    if config["scrape-interval"] == AUTO:
+        low = parse_duration(config["auto-scrape-interval-min"])
+        if low > parse_duration(config["auto-scrape-interval-max"]):
+            raise ConfigError(
+                "auto-scrape-interval-min must not exceed auto-scrape-interval-max"
+            )
+        if not 0 < config["auto-scrape-duty-cycle"] <= 1:
+            raise ConfigError("auto-scrape-duty-cycle must be in (0, 1]")
+    for prefix in ("", "telemetry-"):
+        if not prefix and config["scrape-interval"] == AUTO:
+            # the timeout is chosen along with the interval
+            continue
+        interval = parse_duration(config[f"{prefix}scrape-interval"])
+        if config[f"{prefix}scrape-timeout"]:
+            timeout = parse_duration(config[f"{prefix}scrape-timeout"])
+            if timeout > interval:
+                raise ConfigError(
+                    f"{prefix}scrape-timeout must not exceed {prefix}scrape-interval"
+                )
+    for option in ("telemetry-sample-limit", *STATE_LIMITS):
+        if option != "body-size-limit" and config[option] < 0:
+            raise ConfigError(f"{option} must not be negative")
+    if config["body-size-limit"] and not _SIZE.match(config["body-size-limit"]):
+        raise ConfigError(f"invalid body-size-limit: {config['body-size-limit']!r}")
+    parse_tiers(config["scrape-tiers"])
+    parse_drop_labels(config["drop-labels"])
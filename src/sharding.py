@@ -0,0 +1,89 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+"""Helpers for splitting kube-state-metrics work across units."""
+
+# https://github.com/kubernetes/kube-state-metrics/blob/v2.15.0/docs/developer/cli-arguments.md
+DEFAULT_RESOURCES = (
+    "certificatesigningrequests",
+    "configmaps",
+    "cronjobs",
+    "daemonsets",
+    "deployments",
+    "endpoints",
+    "horizontalpodautoscalers",
+    "ingresses",
+    "jobs",
+    "leases",
+    "limitranges",
+    "mutatingwebhookconfigurations",
+    "namespaces",
+    "networkpolicies",
+    "nodes",
+    "persistentvolumeclaims",
+    "persistentvolumes",
+    "poddisruptionbudgets",
+    "pods",
+    "replicasets",
+    "replicationcontrollers",
+    "resourcequotas",
+    "secrets",
+    "services",
+    "statefulsets",
+    "storageclasses",
+    "validatingwebhookconfigurations",
+    "volumeattachments",
+)
+
+# Relative cost of watching a resource type, roughly proportional to the number
+# of objects of that type in a typical cluster and the series generated for each.
+# Resources not listed here have a weight of 1.
+DEFAULT_WEIGHTS = {
+    "pods": 10,
+    "replicasets": 6,
+    "endpoints": 3,
+    "jobs": 3,
+    "configmaps": 2,
+    "deployments": 2,
+    "secrets": 2,
+    "services": 2,
+}
+
+
+def parse_weights(value):
+    """Parse a `resource=weight,...` string into a dict of weights.
+
+    Raises:
+        ValueError: if the string is malformed or a weight is not a positive integer.
+    """
+    weights = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        resource, sep, weight = item.partition("=")
+        if not sep or not resource.strip():
+            raise ValueError(f"invalid resource weight: {item}")
+        try:
+            weights[resource.strip()] = int(weight)
+        except ValueError:
+            raise ValueError(f"invalid resource weight: {item}") from None
+        if weights[resource.strip()] < 1:
+            raise ValueError(f"invalid resource weight: {item}")
+    return weights
+
+
+def partition_resources(resources, weights, total):
+    """Split resources into `total` partitions of roughly equal weight.
+
+    The heaviest resources are placed first, each into the lightest partition
+    so far, so that expensive resources end up on units of their own. The
+    result is deterministic, so every unit computes the same partitioning.
+
+    Returns:
+        A list of `total` sorted lists of resource names.
+    """
+    partitions = [[] for _ in range(total)]
+    loads = [0] * total
+    for resource in sorted(resources, key=lambda r: (-weights.get(r, 1), r)):
+        lightest = loads.index(min(loads))
+        partitions[lightest].append(resource)
+        loads[lightest] += weights.get(resource, 1)
+    return [sorted(partition) for partition in partitions]
@@ -0,0 +1,330 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+"""Compile charm config into kube-state-metrics command line flags.
+
+Each charm config option passed to kube-state-metrics has an entry in `OPTIONS`
+which parses and validates its value, so that a bad setting blocks the charm
+rather than crash-looping the workload after a restart. Settings which are
+valid but known to be expensive produce warnings.
+
+Options which kube-state-metrics can reload at runtime can alternatively be
+rendered into its options config file (--config), which it watches for changes.
+"""
+
+import re
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Any, NamedTuple
+
+import yaml
+
+
+class ConfigError(ValueError):
+    """Raised when a config option has an invalid value."""
+
+
+class Option(NamedTuple):
+    """Schema for a charm config option passed to kube-state-metrics."""
+
+    flag: str
+    # parses the raw option value into the flag value and a list of warnings
+    parse: Callable[[str, Any], tuple[str, list[str]]]
+    # key in the options config file, for options which can be reloaded at runtime
+    config_key: str | None = None
+    # converts the flag value into the value for the options config file
+    to_file: Callable[[str], Any] = str
+
+
+class CompiledConfig(NamedTuple):
+    """Result of compiling the charm config."""
+
+    flags: tuple[str, ...]
+    warnings: tuple[str, ...]
+    # YAML options config file, if the reloadable options are not given as flags
+    config_file: str = ""
+
+
+# A sample of the metric families exposed by kube-state-metrics, across several
+# resources, used to detect allowlist / denylist patterns which match most of them.
+SAMPLE_FAMILIES = (
+    "kube_configmap_info",
+    "kube_cronjob_next_schedule_time",
+    "kube_daemonset_status_number_ready",
+    "kube_deployment_spec_replicas",
+    "kube_deployment_status_replicas_available",
+    "kube_endpoint_address",
+    "kube_job_status_succeeded",
+    "kube_lease_renew_time",
+    "kube_namespace_status_phase",
+    "kube_node_info",
+    "kube_node_status_allocatable",
+    "kube_node_status_condition",
+    "kube_persistentvolumeclaim_info",
+    "kube_pod_container_resource_requests",
+    "kube_pod_container_status_restarts_total",
+    "kube_pod_info",
+    "kube_pod_labels",
+    "kube_pod_status_phase",
+    "kube_replicaset_owner",
+    "kube_secret_info",
+    "kube_service_info",
+    "kube_statefulset_replicas",
+)
+
+CONFIG_DIR = "/etc/kube-state-metrics"
+CONFIG_FILE_PATH = f"{CONFIG_DIR}/config.yaml"
+CUSTOM_RESOURCE_STATE_PATH = f"{CONFIG_DIR}/custom-resource-state.yaml"
+
+# Limits on custom resource state metrics, which are the easiest way to blow up
+# the cardinality of the exposed metrics.
+MAX_CUSTOM_RESOURCES = 20
+MAX_CUSTOM_RESOURCE_METRICS = 30
+MAX_CUSTOM_RESOURCE_LABELS = 10
+
+# Python regex constructs which Go's RE2, used by kube-state-metrics, rejects.
+_UNSUPPORTED_REGEX = re.compile(r"\(\?[=!]|\(\?<[=!]|\(\?P=|\\[1-9]")
+_NAME = re.compile(r"^[a-z0-9]([-a-z0-9.]*[a-z0-9])?$")
+_LABEL_KEY = re.compile(r"^([a-zA-Z0-9]([-a-zA-Z0-9_./]*[a-zA-Z0-9])?|\*)$")
+_LABELS_ITEM = re.compile(r"\s*([a-z0-9]+)=\[([^\]]*)\]\s*(,|$)")
+
+
+def _split(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _set_value(value):
+    return {item: {} for item in value.split(",")}
+
+
+def _list_value(value):
+    return value.split(",")
+
+
+def _labels_value(value):
+    return {
+        match.group(1): _split(match.group(2)) for match in _LABELS_ITEM.finditer(value)
+    }
+
+
+def _regex_list(option, value):
+    """Parse a comma-separated list of metric names or regexes."""
+    patterns = _split(value)
+    warnings = []
+    for pattern in patterns:
+        if _UNSUPPORTED_REGEX.search(pattern):
+            raise ConfigError(f"{option}: {pattern!r} uses syntax unsupported by RE2")
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            raise ConfigError(f"{option}: invalid regex {pattern!r}: {e}") from None
+        matched = sum(1 for family in SAMPLE_FAMILIES if regex.fullmatch(family))
+        if matched > len(SAMPLE_FAMILIES) // 2:
+            warnings.append(f"{option}: {pattern!r} matches most metric families")
+    return ",".join(patterns), warnings
+
+
+def _name_list(option, value):
+    """Parse a comma-separated list of Kubernetes object names."""
+    names = _split(value)
+    for name in names:
+        if not _NAME.match(name):
+            raise ConfigError(f"{option}: invalid name {name!r}")
+    return ",".join(names), []
+
+
+def _boolean(option, value):
+    """Render an enabled boolean option."""
+    return "true", []
+
+
+def _allowlist(option, value, kind):
+    """Parse a `resource=[key,...],...` list of Kubernetes label or annotation keys."""
+    value = value.strip().lstrip("=")
+    items = []
+    warnings = []
+    pos = 0
+    while pos < len(value):
+        match = _LABELS_ITEM.match(value, pos)
+        if not match:
+            raise ConfigError(f"{option}: invalid syntax at {value[pos:]!r}")
+        resource, keys = match.group(1), _split(match.group(2))
+        for key in keys:
+            if not _LABEL_KEY.match(key):
+                raise ConfigError(f"{option}: invalid {kind} {key!r} for {resource}")
+        if "*" in keys:
+            if len(keys) > 1:
+                raise ConfigError(f"{option}: '*' must be alone for {resource}")
+            warnings.append(
+                f"{option}: {resource}=[*] exposes every {kind} of {resource}, "
+                "which has severe performance implications"
+            )
+        items.append(f"{resource}=[{','.join(keys)}]")
+        pos = match.end()
+    return ",".join(items), warnings
+
+
+def _labels_allowlist(option, value):
+    """Parse a `resource=[label,...],...` list of Kubernetes label keys."""
+    return _allowlist(option, value, "label")
+
+
+def _annotations_allowlist(option, value):
+    """Parse a `resource=[annotation,...],...` list of Kubernetes annotation keys."""
+    return _allowlist(option, value, "annotation")
+
+
+def _mapping(option, value, what):
+    """Check that a part of a YAML config is a mapping, if it is given at all."""
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ConfigError(f"{option}: {what} must be a mapping")
+    return value
+
+
+def _custom_resource_state(option, value):
+    """Validate a custom resource state config, rendering the path it is pushed to."""
+    try:
+        crs = yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise ConfigError(f"{option}: invalid YAML: {e}") from None
+    if not isinstance(crs, dict) or crs.get("kind") != "CustomResourceStateMetrics":
+        raise ConfigError(f"{option}: kind must be CustomResourceStateMetrics")
+    resources = _mapping(option, crs.get("spec"), "spec").get("resources")
+    if not isinstance(resources, list) or not resources:
+        raise ConfigError(f"{option}: spec.resources must be a non-empty list")
+    if len(resources) > MAX_CUSTOM_RESOURCES:
+        raise ConfigError(
+            f"{option}: {len(resources)} resources exceeds limit of {MAX_CUSTOM_RESOURCES}"
+        )
+    warnings = []
+    for resource in resources:
+        resource = _mapping(option, resource, "each resource")
+        gvk = _mapping(option, resource.get("groupVersionKind"), "groupVersionKind")
+        if not gvk.get("version") or not gvk.get("kind"):
+            raise ConfigError(f"{option}: groupVersionKind needs version and kind")
+        kind = gvk["kind"]
+        metrics = resource.get("metrics") or []
+        if not isinstance(metrics, list):
+            raise ConfigError(f"{option}: {kind} metrics must be a list")
+        if not metrics:
+            raise ConfigError(f"{option}: {kind} has no metrics")
+        if len(metrics) > MAX_CUSTOM_RESOURCE_METRICS:
+            raise ConfigError(
+                f"{option}: {kind} has {len(metrics)} metrics, "
+                f"exceeding limit of {MAX_CUSTOM_RESOURCE_METRICS}"
+            )
+        common_labels = len(
+            _mapping(option, resource.get("labelsFromPath"), f"{kind} labelsFromPath")
+        ) + len(_mapping(option, resource.get("commonLabels"), f"{kind} commonLabels"))
+        for metric in metrics:
+            metric = _mapping(option, metric, f"each metric of {kind}")
+            name = metric.get("name")
+            each = _mapping(option, metric.get("each"), f"{kind} metric {name} each")
+            labels = common_labels + len(
+                _mapping(
+                    option,
+                    metric.get("labelsFromPath"),
+                    f"{kind} metric {name} labelsFromPath",
+                )
+            )
+            for spec in each.values():
+                if isinstance(spec, dict):
+                    labels += len(
+                        _mapping(
+                            option,
+                            spec.get("labelsFromPath"),
+                            f"{kind} metric {name} labelsFromPath",
+                        )
+                    )
+            if labels > MAX_CUSTOM_RESOURCE_LABELS:
+                raise ConfigError(
+                    f"{option}: {kind} metric {name} has {labels} labels, "
+                    f"exceeding limit of {MAX_CUSTOM_RESOURCE_LABELS}"
+                )
+            if labels > MAX_CUSTOM_RESOURCE_LABELS // 2:
+                warnings.append(f"{option}: {kind} metric {name} has {labels} labels")
+    return CUSTOM_RESOURCE_STATE_PATH, warnings
+
+
+OPTIONS: dict[str, Option] = {
+    "metric-allowlist": Option(
+        "--metric-allowlist", _regex_list, "metric_allowlist", _set_value
+    ),
+    "metric-denylist": Option(
+        "--metric-denylist", _regex_list, "metric_denylist", _set_value
+    ),
+    "metric-labels-allowlist": Option(
+        "--metric-labels-allowlist",
+        _labels_allowlist,
+        "labels_allow_list",
+        _labels_value,
+    ),
+    "metric-annotations-allowlist": Option(
+        "--metric-annotations-allowlist",
+        _annotations_allowlist,
+        "annotations_allow_list",
+        _labels_value,
+    ),
+    "metric-opt-in-list": Option(
+        "--metric-opt-in-list", _regex_list, "metric_opt_in_list", _set_value
+    ),
+    "namespaces": Option("--namespaces", _name_list, "namespaces", _list_value),
+    "namespaces-denylist": Option(
+        "--namespaces-denylist", _name_list, "namespaces_denylist", _list_value
+    ),
+    "resources": Option("--resources", _name_list, "resources", _set_value),
+    "use-apiserver-cache": Option("--use-apiserver-cache", _boolean),
+    "compression": Option("--enable-gzip-encoding", _boolean),
+    "custom-resource-state": Option(
+        "--custom-resource-state-config-file", _custom_resource_state
+    ),
+}
+
+
+def compile_config(config, config_file=None):
+    """Compile the charm config into kube-state-metrics flags.
+
+    Args:
+        config: a mapping of charm config option names to values; options
+            without an entry in `OPTIONS` are ignored.
+        config_file: optional path of an options config file, into which the
+            options which can be reloaded at runtime are rendered, rather than flags.
+
+    Returns:
+        A `CompiledConfig` with the flags and any warnings about costly settings.
+
+    Raises:
+        ConfigError: if any option has an invalid value.
+    """
+    items = tuple(sorted((k, v) for k, v in config.items() if k in OPTIONS))
+    return _compile(items, config_file)
+
+
+@lru_cache(maxsize=16)
+def _compile(items, config_file):
+    config = dict(items)
+    if config.get("metric-allowlist") and config.get("metric-denylist"):
+        raise ConfigError("metric-allowlist and metric-denylist are mutually exclusive")
+    flags = []
+    warnings = []
+    file_options = {}
+    for key, value in items:
+        if not value:
+            continue
+        option = OPTIONS[key]
+        parsed, option_warnings = option.parse(key, value)
+        warnings.extend(option_warnings)
+        if not parsed:
+            continue
+        if config_file and option.config_key:
+            file_options[option.config_key] = option.to_file(parsed)
+        else:
+            flags.append(f"{option.flag}={parsed}")
+    if config_file:
+        flags.append(f"--config={config_file}")
+        return CompiledConfig(
+            tuple(flags), tuple(warnings), yaml.safe_dump(file_options)
+        )
+    return CompiledConfig(tuple(flags), tuple(warnings))
@@ -0,0 +1,137 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+"""Benchmark the exposition parser over synthetic kube-state-metrics output.
+
+Run with `tox -e benchmark`, or `python tests/benchmark/bench_exposition.py -h`
+for the options. Each run is in a fresh process, so that the peak RSS reported
+is that of parsing one exposition.
+"""
+
+import argparse
+import io
+import multiprocessing
+import resource
+import time
+
+import exposition
+
+# families of pod metrics, with the number of series per pod, the extra labels
+# of each series and the label whose value varies between the series
+POD_FAMILIES = (
+    ("kube_pod_info", 1, 'host_ip="10.0.0.1",node="node-{node}",uid="{uid}"', None),
+    ("kube_pod_labels", 1, 'label_app="app-{app}",label_team="team-{team}"', None),
+    ("kube_pod_status_phase", 5, "", "phase"),
+    ("kube_pod_status_ready", 3, "", "condition"),
+    (
+        "kube_pod_container_info",
+        2,
+        'image_id="sha256:{uid}",container_id="{uid}"',
+        "container",
+    ),
+    (
+        "kube_pod_container_resource_requests",
+        4,
+        'node="node-{node}",unit="core"',
+        "resource",
+    ),
+    ("kube_pod_container_status_restarts_total", 2, "", "container"),
+    ("kube_pod_owner", 1, 'owner_kind="ReplicaSet",owner_name="rs-{app}"', None),
+)
+SERIES_PER_POD = sum(count for _, count, _, _ in POD_FAMILIES)
+
+
+class SyntheticExposition(io.RawIOBase):
+    """A stream of a synthetic exposition with roughly the given number of samples.
+
+    The exposition is generated as it is read, so that it does not take any
+    memory of its own.
+    """
+
+    def __init__(self, samples, namespaces=200):
+        self.pods = max(1, samples // SERIES_PER_POD)
+        self.namespaces = namespaces
+        self.buffer = b""
+        self.chunks = self._generate()
+
+    def _generate(self):
+        for family, count, extra, varying in POD_FAMILIES:
+            lines = [
+                f"# HELP {family} Synthetic {family}.\n",
+                f"# TYPE {family} gauge\n",
+            ]
+            for pod in range(self.pods):
+                labels = f'namespace="ns-{pod % self.namespaces}",pod="pod-{pod}"'
+                if extra:
+                    labels += "," + extra.format(
+                        node=pod % 500, uid=f"{pod:032x}", app=pod % 300, team=pod % 20
+                    )
+                for i in range(count):
+                    vary = f',{varying}="{varying}-{i}"' if varying else ""
+                    lines.append(f"{family}{{{labels}{vary}}} 1\n")
+                if len(lines) > 10000:
+                    yield "".join(lines).encode()
+                    lines = []
+            yield "".join(lines).encode()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) < len(b):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def _run(samples, results):
+    stream = io.BufferedReader(SyntheticExposition(samples), exposition.CHUNK_SIZE)
+    start = time.perf_counter()
+    stats = exposition.family_stats(stream)
+    elapsed = time.perf_counter() - start
+    results.put(
+        {
+            "samples": sum(family.series for family in stats.values()),
+            "bytes": sum(family.bytes for family in stats.values()),
+            "seconds": elapsed,
+            # ru_maxrss is in KB on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "samples",
+        nargs="*",
+        type=int,
+        default=[1_000_000, 3_000_000, 10_000_000],
+        help="number of samples of each exposition (default: 1M, 3M and 10M)",
+    )
+    args = parser.parse_args()
+    print(
+        f"{'samples':>12} {'MB':>8} {'seconds':>8} {'samples/s':>11} {'MB/s':>7} {'peak RSS MB':>12}"
+    )
+    context = multiprocessing.get_context("spawn")
+    for samples in args.samples:
+        results = context.Queue()
+        process = context.Process(target=_run, args=(samples, results))
+        process.start()
+        result = results.get()
+        process.join()
+        mb = result["bytes"] / 2**20
+        print(
+            f"{result['samples']:>12} {mb:>8.1f} {result['seconds']:>8.1f} "
+            f"{result['samples'] / result['seconds']:>11.0f} "
+            f"{mb / result['seconds']:>7.1f} {result['peak_rss_mb']:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,31 @@
 # Copyright 2021 Cory Johns
 # See LICENSE file for licensing details.
 
+import io
+import itertools
+import json
+from unittest.mock import patch
+from urllib.error import URLError
+
 import pytest
-from ops.model import ActiveStatus, BlockedStatus
-from ops.testing import Harness
+from ops.model import (
+    ActiveStatus,
+    BlockedStatus,
+    Container,
+    MaintenanceStatus,
+    WaitingStatus,
+)
+from ops.pebble import CheckStartup, CheckStatus
+from ops.testing import ActionFailed, Harness
+
 from charm import KubeStateMetricsOperator
+from sharding import DEFAULT_RESOURCES
+
+
+@pytest.fixture(autouse=True)
+def urlopen():
+    with patch("charm.urlopen") as urlopen:
+        yield urlopen
 
 
 @pytest.fixture
@@ -23,7 +44,7 @@ def test_valid_config(harness):
     harness.update_config(
         {
             "metric-allowlist": "foo",
-            "metric-labels-allowlist": "foo",
+            "metric-labels-allowlist": "pods=[app]",
             "namespaces": "foo",
             "resources": "foo",
         }
@@ -42,3 +63,614 @@ def test_invalid_config(harness):
         }
     )
     assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_restart_only_on_layer_change(harness):
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    container = harness.charm.unit.get_container("kube-state-metrics")
+    assert container.get_service("kube-state-metrics").is_running()
+
+    with patch.object(Container, "restart") as restart:
+        # scrape-interval is not a workload flag, so must not restart the workload
+        harness.update_config({"scrape-interval": "2m"})
+        restart.assert_not_called()
+
+        harness.update_config({"namespaces": "foo"})
+        restart.assert_called_once_with("kube-state-metrics")
+    assert (
+        "--namespaces=foo" in harness.charm.layer.services["kube-state-metrics"].command
+    )
+
+
+def test_scrape_interval_refreshes_relation(harness):
+    harness.set_leader(True)
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    harness.begin()
+
+    harness.update_config({"scrape-interval": "2m"})
+    jobs = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app)["scrape_jobs"]
+    )
+    assert jobs[0]["scrape_interval"] == "2m"
+
+
+def test_sharding_by_unit(harness):
+    harness.set_planned_units(3)
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--shard" not in command
+
+    harness.update_config({"sharding": "units"})
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--shard=0 --total-shards=3" in command
+    assert "--sharding" not in command
+    assert harness.charm.unit.status.message.startswith("Shard 0 of 3,")
+
+    # scaling down past this unit leaves it waiting to be removed
+    harness.set_planned_units(0)
+    harness.update_config({"namespaces": "foo"})
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+
+
+def test_invalid_sharding(harness):
+    harness.begin()
+    harness.update_config({"sharding": "bogus"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_sharding_by_statefulset(harness):
+    harness.set_model_name("observability")
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    harness.update_config({"sharding": "statefulset"})
+    service = harness.charm.layer.services["kube-state-metrics"]
+    assert "--pod=kube-state-metrics-0 --pod-namespace=observability" in service.command
+    assert "--shard" not in service.command
+    assert service.environment == {
+        "POD_NAME": "kube-state-metrics-0",
+        "POD_NAMESPACE": "observability",
+    }
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+
+def test_sharding_by_resources(harness):
+    harness.set_planned_units(2)
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    harness.update_config(
+        {
+            "sharding": "resources",
+            "resources": "pods,nodes,secrets",
+            "resource-weights": "secrets=20",
+        }
+    )
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert command.endswith("--resources=secrets")
+    assert "--resources=pods" not in command
+    assert "--resource-weights" not in command
+    assert harness.charm.unit.status.message.startswith(
+        "Partition 0 of 2 (1 resources)"
+    )
+
+    harness.update_config({"resource-weights": "leases=2"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+    harness.set_planned_units(4)
+    harness.update_config({"resource-weights": ""})
+    assert harness.charm.unit.status.message.startswith(
+        "Partition 0 of 4 (1 resources)"
+    )
+
+
+def test_ready_gated_status(harness, urlopen):
+    urlopen.side_effect = URLError("connection refused")
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    assert isinstance(harness.charm.unit.status, MaintenanceStatus)
+    plan = harness.get_container_pebble_plan("kube-state-metrics")
+    assert set(plan.checks) == {"kube-state-metrics-alive", "kube-state-metrics-ready"}
+
+    urlopen.side_effect = None
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status.name == "active"
+    assert "first scrape after" in harness.charm.unit.status.message
+
+    # no restart, so no new wait for readiness
+    urlopen.side_effect = URLError("connection refused")
+    harness.update_config({"scrape-interval": "2m"})
+    assert harness.charm.unit.status.name == "active"
+
+
+def test_rolling_restart(harness):
+    harness.set_leader(True)
+    rel_id = harness.add_relation("cluster", "kube-state-metrics")
+    harness.add_relation_unit(rel_id, "kube-state-metrics/1")
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    # initial start of the workload doesn't need the lock
+    assert harness.charm.unit.status.name == "active"
+    assert not harness.get_relation_data(rel_id, harness.charm.app)
+
+    # another unit is restarting, so this one waits for it to finish
+    harness.update_relation_data(
+        rel_id, "kube-state-metrics/1", {"restart": "requested"}
+    )
+    assert harness.get_relation_data(rel_id, harness.charm.app) == {
+        "restart-granted": "kube-state-metrics/1"
+    }
+    with patch.object(Container, "restart") as restart:
+        harness.update_config({"namespaces": "foo"})
+        restart.assert_not_called()
+    assert harness.charm.unit.status == WaitingStatus("Waiting for rolling restart")
+    assert harness.get_relation_data(rel_id, "kube-state-metrics/0") == {
+        "restart": "requested"
+    }
+
+    # once it is done, the lock passes to this unit which restarts and releases it
+    with patch.object(Container, "restart") as restart:
+        harness.update_relation_data(rel_id, "kube-state-metrics/1", {"restart": ""})
+        restart.assert_called_once_with("kube-state-metrics")
+    assert harness.charm.unit.status.name == "active"
+    assert not harness.get_relation_data(rel_id, "kube-state-metrics/0").get("restart")
+    assert not harness.get_relation_data(rel_id, harness.charm.app)
+
+
+def test_config_flags(harness):
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    harness.update_config({"metric-denylist": "kube_pod_(info"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "metric-denylist: invalid regex 'kube_pod_(info': "
+        "missing ), unterminated subpattern at position 9"
+    )
+
+    harness.update_config(
+        {"metric-denylist": "kube_secret_.*", "metric-labels-allowlist": "pods=[*]"}
+    )
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--metric-denylist=kube_secret_.*" in command
+    assert "'--metric-labels-allowlist=pods=[*]'" in command
+    assert "costly config" in harness.charm.unit.status.message
+
+
+def test_use_apiserver_cache(harness):
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--use-apiserver-cache" not in command
+
+    harness.update_config({"use-apiserver-cache": True})
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--use-apiserver-cache=true" in command
+    assert "using apiserver cache" in harness.charm.unit.status.message
+
+
+def test_custom_resource_state(harness):
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    container = harness.charm.unit.get_container("kube-state-metrics")
+    path = "/etc/kube-state-metrics/custom-resource-state.yaml"
+    crs = "kind: CustomResourceStateMetrics\nspec:\n  resources:\n{}"
+    resource = (
+        "  - groupVersionKind: {{version: v1, kind: {}}}\n"
+        "    metrics: [{{name: up, each: {{type: Gauge, gauge: {{path: [status]}}}}}}]\n"
+    )
+
+    with patch.object(Container, "restart") as restart:
+        harness.update_config(
+            {"custom-resource-state": crs.format(resource.format("Foo"))}
+        )
+        restart.assert_called_once_with("kube-state-metrics")
+    assert "kind: Foo" in container.pull(path).read()
+    service = harness.charm.layer.services["kube-state-metrics"]
+    assert f"--custom-resource-state-config-file={path}" in service.command
+    assert "CUSTOM_RESOURCE_STATE_SHA256" in service.environment
+
+    # unchanged content is neither pushed nor restarted
+    with patch.object(Container, "restart") as restart:
+        with patch.object(Container, "push") as push:
+            harness.update_config({"scrape-interval": "2m"})
+            push.assert_not_called()
+        restart.assert_not_called()
+
+    with patch.object(Container, "restart") as restart:
+        harness.update_config(
+            {"custom-resource-state": crs.format(resource.format("Bar"))}
+        )
+        restart.assert_called_once_with("kube-state-metrics")
+    assert "kind: Bar" in container.pull(path).read()
+
+    # the custom resources are served by only one process, to not duplicate them
+    harness.update_config({"scrape-tiers": "slow:10m:configmaps"})
+    services = harness.charm.layer.services
+    assert "--custom-resource-state" in services["kube-state-metrics"].command
+    slow = services["kube-state-metrics-slow"]
+    assert "--custom-resource-state" not in slow.command
+    assert "CUSTOM_RESOURCE_STATE_SHA256" not in slow.environment
+
+    harness.set_planned_units(2)
+    harness.update_config({"scrape-tiers": "", "sharding": "resources"})
+    assert (
+        "--custom-resource-state"
+        in harness.charm.layer.services["kube-state-metrics"].command
+    )
+    with patch.object(type(harness.charm), "shard", (1, 2)):
+        command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--custom-resource-state" not in command
+
+
+def test_hot_reload(harness):
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    container = harness.charm.unit.get_container("kube-state-metrics")
+    path = "/etc/kube-state-metrics/config.yaml"
+
+    harness.update_config({"hot-reload": True, "namespaces": "foo"})
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert f"--config={path}" in command
+    assert "--namespaces" not in command
+    assert "namespaces:\n- foo\n" == container.pull(path).read()
+
+    # reloadable options are pushed without restarting the workload
+    with patch.object(Container, "restart") as restart:
+        harness.update_config({"namespaces": "bar"})
+        restart.assert_not_called()
+    assert "namespaces:\n- bar\n" == container.pull(path).read()
+
+
+def test_telemetry_scrape_job(harness):
+    harness.set_leader(True)
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    harness.begin()
+
+    harness.update_config({"telemetry-scrape-interval": "15s"})
+    jobs = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app)["scrape_jobs"]
+    )
+    assert [job["job_name"] for job in jobs] == ["kube-state-metrics", "telemetry"]
+    assert jobs[1]["scrape_interval"] == "15s"
+    assert jobs[1]["static_configs"] == [{"targets": ["*:8081"]}]
+
+    harness.update_config({"telemetry-scrape-timeout": "30s"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "telemetry-scrape-timeout must not exceed telemetry-scrape-interval"
+    )
+
+
+def test_scrape_tiers(harness):
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    harness.update_config({"scrape-tiers": "slow:10m:configmaps,secrets"})
+    services = harness.charm.layer.services
+    assert set(services) == {"kube-state-metrics", "kube-state-metrics-slow"}
+    slow = services["kube-state-metrics-slow"].command
+    assert "--port=8090 --telemetry-port=8091 --resources=configmaps,secrets" in slow
+    main = services["kube-state-metrics"].command
+    assert "--resources=" in main and "configmaps" not in main
+    container = harness.charm.unit.get_container("kube-state-metrics")
+    assert container.get_service("kube-state-metrics-slow").is_running()
+    assert "2 scrape tiers" in harness.charm.unit.status.message
+    checks = harness.charm.layer.checks
+    assert checks["kube-state-metrics-slow-alive"].http == {
+        "url": "http://localhost:8090/healthz"
+    }
+    assert checks["kube-state-metrics-slow-ready"].http == {
+        "url": "http://localhost:8091/readyz"
+    }
+
+    # removing the tier stops its process and checks
+    harness.update_config({"scrape-tiers": ""})
+    assert not container.get_service("kube-state-metrics-slow").is_running()
+    check = container.get_checks("kube-state-metrics-slow-alive")[
+        "kube-state-metrics-slow-alive"
+    ]
+    assert check.startup == CheckStartup.DISABLED
+    assert check.status == CheckStatus.INACTIVE
+    assert (
+        "--resources" not in container.get_plan().services["kube-state-metrics"].command
+    )
+
+    # adding the tier back enables its process again, without restarting it later
+    harness.update_config({"scrape-tiers": "slow:10m:configmaps,secrets"})
+    assert container.get_service("kube-state-metrics-slow").is_running()
+    assert container.get_plan().services == harness.charm.layer.services
+    assert container.get_plan().checks == harness.charm.layer.checks
+    check = container.get_checks("kube-state-metrics-slow-alive")[
+        "kube-state-metrics-slow-alive"
+    ]
+    assert check.status == CheckStatus.UP
+    with patch.object(type(container), "restart") as restart:
+        harness.update_config({"scrape-interval": "2m"})
+    restart.assert_not_called()
+    harness.update_config({"scrape-tiers": "slow:10m:configmaps"})
+    assert container.get_plan().services == harness.charm.layer.services
+
+    harness.update_config({"scrape-tiers": "all:10m:" + ",".join(DEFAULT_RESOURCES)})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_scrape_limits(harness):
+    harness.set_leader(True)
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    harness.begin()
+
+    harness.update_config(
+        {
+            "scrape-timeout": "30s",
+            "label-value-length-limit": 512,
+            "body-size-limit": "1GB",
+        }
+    )
+    jobs = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app)["scrape_jobs"]
+    )
+    assert jobs[0]["scrape_timeout"] == "30s"
+    assert jobs[0]["label_value_length_limit"] == 512
+    assert jobs[0]["body_size_limit"] == "1GB"
+    assert "body_size_limit" not in jobs[1]
+
+
+def test_invalid_scrape_settings(harness):
+    harness.set_leader(True)
+    harness.update_config({"scrape-timeout": "5m"})
+    harness.begin()
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    jobs = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app)["scrape_jobs"]
+    )
+    assert jobs[0]["scrape_interval"] == "1m"
+    assert "scrape_timeout" not in jobs[0]
+
+    # the charm is constructed for every hook, when the last valid jobs are kept
+    harness.update_config({"scrape-timeout": "30s", "scrape-interval": "2m"})
+    harness.update_config({"scrape-timeout": "5m", "body-size-limit": "lots"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+    assert harness.charm.scrape_jobs[0]["scrape_timeout"] == "30s"
+    assert "body_size_limit" not in harness.charm.scrape_jobs[0]
+
+
+def test_compression(harness):
+    harness.set_leader(True)
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+
+    harness.update_config({"compression": True})
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--enable-gzip-encoding=true" in command
+    jobs = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app)["scrape_jobs"]
+    )
+    assert "enable_compression" not in jobs[0]
+
+
+def test_compute_resources(harness):
+    harness.set_leader(True)
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+
+    with patch("compute_resources.patch_statefulset") as patch_statefulset:
+        harness.update_config({"namespaces": "foo"})
+        patch_statefulset.assert_not_called()
+
+        harness.update_config({"cpu-limit": "2", "memory-limit": "1Gi"})
+        patch_statefulset.assert_called_once_with(
+            "kube-state-metrics",
+            harness.model.name,
+            "kube-state-metrics",
+            {},
+            {"cpu": "2", "memory": "1Gi"},
+        )
+    environment = harness.charm.layer.services["kube-state-metrics"].environment
+    assert environment["GOMAXPROCS"] == "2"
+    assert environment["GOMEMLIMIT"] == str(int(2**30 * 0.9))
+
+    harness.update_config({"memory-request": "2Gi"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "memory-request must not exceed memory-limit"
+    )
+
+
+def test_active_standby(harness):
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    peer_id = harness.add_relation("cluster", "kube-state-metrics")
+    harness.add_relation_unit(peer_id, "kube-state-metrics/1")
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    unit_data = harness.get_relation_data(rel_id, "kube-state-metrics/0")
+    assert "prometheus_scrape_unit_address" in unit_data
+
+    # the standby withdraws its address, so that only the leader is scraped
+    harness.update_config({"active-standby": True})
+    unit_data = harness.get_relation_data(rel_id, "kube-state-metrics/0")
+    assert "prometheus_scrape_unit_address" not in unit_data
+    assert "standby" in harness.charm.unit.status.message
+
+    # and takes over once elected
+    harness.set_leader(True)
+    unit_data = harness.get_relation_data(rel_id, "kube-state-metrics/0")
+    assert "prometheus_scrape_unit_address" in unit_data
+    assert harness.get_relation_data(peer_id, harness.charm.app) == {
+        "scraped-unit": "kube-state-metrics/0"
+    }
+    assert "scraped" in harness.charm.unit.status.message
+
+    harness.update_config({"sharding": "units"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "active-standby cannot be combined with sharding"
+    )
+
+
+def test_max_series(harness, urlopen):
+    body = (
+        b"".join(f'kube_pod_info{{pod="p{i}"}} 1\n'.encode() for i in range(8))
+        + b'kube_node_info{node="n"} 1\nkube_secret_info{secret="s"} 1\n'
+    )
+    urlopen.return_value.__enter__.side_effect = lambda: io.BytesIO(body)
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+    harness.update_config({"max-series": 5})
+
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status == BlockedStatus(
+        "10 series exceeds max-series: kube_pod_info (8), "
+        "kube_node_info (1), kube_secret_info (1)"
+    )
+
+    with patch.object(Container, "restart") as restart:
+        harness.update_config({"max-series-action": "deny"})
+        restart.assert_not_called()
+        harness.charm.on.update_status.emit()
+        restart.assert_called_once_with("kube-state-metrics")
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--metric-denylist=kube_pod_info" in command
+    assert "1 families denied by max-series" in harness.charm.unit.status.message
+
+    # changing the config restores the denied families until the next check
+    harness.update_config({"metric-denylist": "kube_secret_info"})
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--metric-denylist=kube_secret_info" in command
+
+    # an allowlist set after families were denied doesn't conflict with them
+    harness.update_config({"metric-denylist": ""})
+    harness.charm.on.update_status.emit()
+    assert "1 families denied by max-series" in harness.charm.unit.status.message
+    harness.update_config({"metric-allowlist": "kube_node_info"})
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+    command = harness.charm.layer.services["kube-state-metrics"].command
+    assert "--metric-denylist" not in command
+
+
+def test_cardinality_report(harness, urlopen):
+    body = b"".join(
+        f'kube_pod_info{{namespace="ns{i % 2}",pod="p{i}"}} 1\n'.encode()
+        for i in range(5)
+    )
+    urlopen.return_value.__enter__.side_effect = lambda: io.BytesIO(body)
+    harness.begin()
+    output = harness.run_action("cardinality-report", {"top": 1})
+    assert output.results["series"] == 5
+    assert output.results["by-series"] == ("kube_pod_info: 5 series (ns0: 3, ns1: 2)")
+    assert output.results["by-label-cardinality"] == "kube_pod_info: pod has 5 values"
+
+    urlopen.side_effect = URLError("connection refused")
+    with pytest.raises(ActionFailed):
+        harness.run_action("cardinality-report")
+
+
+def test_scrape_probe(harness, urlopen):
+    body = b'kube_pod_info{pod="a"} 1\nkube_pod_info{pod="b"} 1\n'
+    urlopen.return_value.__enter__.side_effect = lambda: io.BytesIO(body)
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+
+    # probing is opt-in, since parsing a large exposition takes long
+    harness.charm.on.update_status.emit()
+    assert not harness.charm._stored.scrape_probes
+    harness.update_config({"probe-scrapes": True})
+
+    harness.charm.on.update_status.emit()
+    assert "scrape 0.0s, 0.0MB, 2 series" in harness.charm.unit.status.message
+    assert "slow scrape" not in harness.charm.unit.status.message
+
+    # each step of the probe takes 3s, so the scrape takes 9s of its 10s timeout
+    with patch("time.perf_counter", side_effect=itertools.count(step=3.0)):
+        harness.charm.on.update_status.emit()
+    assert (
+        "slow scrape of kube-state-metrics: 9.0s of 10s"
+        in harness.charm.unit.status.message
+    )
+    probes = harness.charm._stored.scrape_probes["kube-state-metrics"]
+    assert [list(probe[2:]) for probe in probes] == [[50, 2], [50, 2]]
+    assert probes[-1][1] == 9.0
+    # the readings must be saved at the end of the hook
+    harness.framework.commit()
+
+    harness.update_config({"scrape-timeout": "30s"})
+    assert "slow scrape" not in harness.charm.unit.status.message
+
+
+def test_auto_scrape_interval(harness, urlopen):
+    urlopen.return_value.__enter__.side_effect = lambda: io.BytesIO(b"up 1\n")
+    harness.set_leader(True)
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    peer_id = harness.add_relation("cluster", "kube-state-metrics")
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+
+    def state_job():
+        jobs = harness.get_relation_data(rel_id, harness.charm.app)["scrape_jobs"]
+        return json.loads(jobs)[0]
+
+    harness.update_config({"scrape-interval": "auto"})
+    assert state_job()["scrape_interval"] == "300s"
+    assert state_job()["scrape_timeout"] == "300s"
+
+    # each step of the probe takes 2s, so the scrape takes 6s
+    with patch("time.perf_counter", side_effect=itertools.count(step=2.0)):
+        harness.charm.on.update_status.emit()
+    assert state_job()["scrape_interval"] == "60s"
+    assert state_job()["scrape_timeout"] == "18s"
+    assert "scraped every 60s" in harness.charm.unit.status.message
+
+    # the choice is shared with the other units, and any later leader
+    assert harness.get_relation_data(peer_id, "kube-state-metrics") == {
+        "auto-scrape": "60,18"
+    }
+    harness.set_leader(False)
+    assert harness.charm.scrape_settings["scrape-interval"] == "60s"
+    harness.set_leader(True)
+
+    harness.update_config({"auto-scrape-interval-max": "40s"})
+    assert state_job()["scrape_interval"] == "40s"
+
+    harness.update_config({"auto-scrape-interval-max": "forever"})
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+    assert harness.charm.scrape_settings["scrape-interval"] == "1m"
+    assert not harness.charm.scrape_settings["scrape-timeout"]
+
+
+def test_capture_profiles(harness, urlopen):
+    urlopen.return_value.__enter__.side_effect = lambda: io.BytesIO(b"profile")
+    harness.begin()
+    harness.container_pebble_ready("kube-state-metrics")
+
+    output = harness.run_action(
+        "capture-profiles", {"profiles": "cpu,heap", "duration": 5}
+    )
+    assert urlopen.call_args_list[-2].args == (
+        "http://localhost:8080/debug/pprof/profile?seconds=5",
+    )
+    assert set(output.results) == {"cpu", "heap"}
+    path = output.results["heap"]["path"]
+    assert path.startswith(
+        "/var/lib/kube-state-metrics/profiles/kube-state-metrics-heap-"
+    )
+    assert output.results["heap"]["size"] == 7
+    container = harness.charm.unit.get_container("kube-state-metrics")
+    assert container.pull(path, encoding=None).read() == b"profile"
+
+    with pytest.raises(ActionFailed):
+        harness.run_action("capture-profiles", {"profiles": "mutex"})
+    with pytest.raises(ActionFailed):
+        harness.run_action("capture-profiles", {"process": "kube-state-metrics-slow"})
+
+
+def test_invalid_drop_labels(harness):
+    harness.update_config({"drop-labels": "foo-bar"})
+    # the charm is constructed for every hook, so must not fail on bad config
+    harness.begin()
+    assert "metric_relabel_configs" not in harness.charm.scrape_jobs[0]
+    harness.container_pebble_ready("kube-state-metrics")
+    assert harness.charm.unit.status == BlockedStatus(
+        "drop-labels: invalid label 'foo-bar'"
+    )
@@ -0,0 +1,86 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+from unittest.mock import patch
+
+import pytest
+from lightkube.models.apps_v1 import StatefulSetSpec
+from lightkube.models.core_v1 import (
+    Container,
+    PodSpec,
+    PodTemplateSpec,
+    ResourceRequirements,
+)
+from lightkube.models.meta_v1 import LabelSelector
+from lightkube.resources.apps_v1 import StatefulSet
+
+from compute_resources import (
+    go_runtime_environment,
+    parse_quantity,
+    patch_statefulset,
+    resource_requirements,
+)
+from workload_config import ConfigError
+
+CONFIG = {
+    "cpu-request": "",
+    "cpu-limit": "",
+    "memory-request": "",
+    "memory-limit": "",
+}
+
+
+def test_parse_quantity():
+    assert parse_quantity("cpu-limit", "250m") == 0.25
+    assert parse_quantity("cpu-limit", "2") == 2
+    assert parse_quantity("memory-limit", "1Gi") == 2**30
+    assert parse_quantity("memory-limit", "1.5M") == 1.5e6
+    for value in ("", "1x", "Gi", "-1"):
+        with pytest.raises(ConfigError):
+            parse_quantity("memory-limit", value)
+
+
+def test_resource_requirements():
+    assert resource_requirements(CONFIG) == ({}, {})
+    config = dict(CONFIG, **{"cpu-request": "500m", "memory-limit": "1Gi"})
+    assert resource_requirements(config) == ({"cpu": "500m"}, {"memory": "1Gi"})
+
+    config = dict(CONFIG, **{"memory-request": "2Gi", "memory-limit": "1Gi"})
+    with pytest.raises(ConfigError):
+        resource_requirements(config)
+
+
+def test_go_runtime_environment():
+    assert go_runtime_environment({}) == {}
+    assert go_runtime_environment({"cpu": "1500m", "memory": "1000Mi"}) == {
+        "GOMAXPROCS": "2",
+        "GOMEMLIMIT": str(int(1000 * 2**20 * 0.9)),
+    }
+    assert go_runtime_environment({"cpu": "100m"}) == {"GOMAXPROCS": "1"}
+
+
+def test_patch_statefulset():
+    resources = ResourceRequirements(requests={"cpu": "500m"}, limits={"memory": "1Gi"})
+    statefulset = StatefulSet(
+        spec=StatefulSetSpec(
+            selector=LabelSelector(),
+            serviceName="ksm",
+            template=PodTemplateSpec(
+                spec=PodSpec(containers=[Container(name="ksm", resources=resources)])
+            ),
+        )
+    )
+    with patch("compute_resources.Client") as client:
+        client.return_value.get.return_value = statefulset
+        # the API server returns the quantities normalized
+        assert not patch_statefulset(
+            "ksm", "cos", "ksm", {"cpu": "0.5"}, {"memory": "1024Mi"}
+        )
+        client.return_value.patch.assert_not_called()
+
+        assert patch_statefulset("ksm", "cos", "ksm", {"cpu": "1"}, {})
+        patch_ = client.return_value.patch.call_args.args[2]
+        assert patch_["spec"]["template"]["spec"]["containers"][0]["resources"] == {
+            "requests": {"cpu": "1", "memory": None},
+            "limits": {"cpu": None, "memory": None},
+        }
@@ -0,0 +1,100 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+import io
+
+from exposition import (
+    LabelCardinality,
+    Metadata,
+    Sample,
+    family_stats,
+    labels,
+    parse,
+    report,
+    series_per_family,
+)
+
+EXPOSITION = b"""\
+# HELP kube_pod_info Information about pod.
+# TYPE kube_pod_info gauge
+kube_pod_info{namespace="default",pod="a",uid="1"} 1
+kube_pod_info{namespace="default",pod="b",uid="2"} 1
+# HELP kube_pod_labels Kubernetes labels converted to Prometheus labels.
+# TYPE kube_pod_labels gauge
+kube_pod_labels{namespace="default",pod="a"} 1
+
+# HELP kube_job_duration A histogram of job durations.
+# TYPE kube_job_duration histogram
+kube_job_duration_bucket{le="1"} 0
+kube_job_duration_bucket{le="+Inf"} 1
+kube_job_duration_sum 3
+kube_job_duration_count 1
+kube_node_info{node="n1"} 1
+"""
+
+
+def test_series_per_family():
+    counts = series_per_family(EXPOSITION.splitlines(keepends=True))
+    assert counts == {
+        "kube_pod_info": 2,
+        "kube_pod_labels": 1,
+        "kube_job_duration": 4,
+        "kube_node_info": 1,
+    }
+
+
+def test_family_stats():
+    stats = family_stats(EXPOSITION.splitlines(keepends=True))
+    assert stats["kube_pod_info"].series == 2
+    assert stats["kube_pod_info"].namespaces == {"default": 2}
+    assert stats["kube_pod_info"].cardinality == ("pod", 2)
+    assert stats["kube_job_duration"].cardinality == ("le", 2)
+    assert stats["kube_job_duration"].bytes == 123
+
+    result = report(stats, top=2)
+    assert result["by-series"] == (
+        "kube_job_duration: 4 series\nkube_pod_info: 2 series (default: 2)"
+    )
+    assert result["by-label-cardinality"].startswith("kube_pod_info: pod has 2 values")
+    assert result["by-bytes"].startswith("kube_job_duration: 123 bytes")
+
+
+def test_parse():
+    # a small chunk size splits lines across chunks
+    items = list(parse(io.BytesIO(EXPOSITION), chunk_size=7))
+    assert items[:3] == [
+        Metadata(b"kube_pod_info", b"HELP", b"Information about pod."),
+        Metadata(b"kube_pod_info", b"TYPE", b"gauge"),
+        Sample(
+            b"kube_pod_info",
+            b"kube_pod_info",
+            b'namespace="default",pod="a",uid="1"',
+            b"1",
+            53,
+        ),
+    ]
+    assert list(labels(items[2])) == [
+        (b"namespace", b"default"),
+        (b"pod", b"a"),
+        (b"uid", b"1"),
+    ]
+    assert items[-1] == Sample(
+        b"kube_node_info", b"kube_node_info", b'node="n1"', b"1", 28
+    )
+    assert items[-2].name == b"kube_job_duration_count"
+    assert items[-2].family == b"kube_job_duration"
+
+    sample = next(parse([b'kube_secret_info{secret="a\\"b,c"} 1\n']))
+    assert list(labels(sample)) == [(b"secret", b'a\\"b,c')]
+
+
+def test_label_cardinality():
+    values = LabelCardinality()
+    for i in range(1000):
+        values.add(f"pod-{i % 500}".encode())
+    assert len(values) == 500
+
+    # beyond the exact limit, the count is estimated
+    for i in range(100000):
+        values.add(f"pod-{i}".encode())
+    assert abs(len(values) - 100000) < 5000
@@ -0,0 +1,20 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+from metrics_endpoint import sanitize_scrape_configuration
+
+
+def test_sanitize_scrape_configuration():
+    job = {
+        "job_name": "kube-state-metrics",
+        "static_configs": [{"targets": ["*:8080"]}],
+        "metric_relabel_configs": [{"action": "labeldrop", "regex": "uid"}],
+        "label_value_length_limit": 1024,
+        "body_size_limit": "200MB",
+        "honor_labels": True,
+    }
+    sanitized = sanitize_scrape_configuration(job)
+    assert sanitized == {
+        "metrics_path": "/metrics",
+        **{key: value for key, value in job.items() if key != "honor_labels"},
+    }
@@ -0,0 +1,166 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+import pytest
+
+from scrape_config import (
+    Tier,
+    auto_scrape,
+    metric_relabel_configs,
+    parse_drop_labels,
+    parse_duration,
+    parse_tiers,
+    scrape_jobs,
+    scrape_timeout,
+    validate,
+)
+from workload_config import ConfigError
+
+CONFIG = {
+    "scrape-interval": "2m",
+    "scrape-timeout": "90s",
+    "sample-limit": 500000,
+    "label-limit": 0,
+    "label-name-length-limit": 0,
+    "label-value-length-limit": 1024,
+    "body-size-limit": "200MB",
+    "compression": False,
+    "telemetry-scrape-interval": "15s",
+    "telemetry-scrape-timeout": "",
+    "telemetry-sample-limit": 0,
+    "scrape-tiers": "",
+    "drop-labels": "",
+    "auto-scrape-interval-min": "30s",
+    "auto-scrape-interval-max": "5m",
+    "auto-scrape-duty-cycle": 0.1,
+}
+
+
+def test_parse_duration():
+    assert parse_duration("1m30s") == 90
+    assert parse_duration("1h") == 3600
+    assert parse_duration("250ms") == 0.25
+    for value in ("", "1", "1x", "m"):
+        with pytest.raises(ConfigError):
+            parse_duration(value)
+
+
+def test_scrape_timeout():
+    assert scrape_timeout("30s", "1m") == 30
+    assert scrape_timeout("", "1m") == 10
+    assert scrape_timeout("", "5s") == 5
+
+
+def test_scrape_jobs():
+    validate(CONFIG)
+    state, telemetry = scrape_jobs(CONFIG)
+    assert state == {
+        "job_name": "kube-state-metrics",
+        "scrape_interval": "2m",
+        "scrape_timeout": "90s",
+        "sample_limit": 500000,
+        "label_value_length_limit": 1024,
+        "body_size_limit": "200MB",
+        "static_configs": [{"targets": ["*:8080"]}],
+    }
+    assert telemetry == {
+        "job_name": "telemetry",
+        "scrape_interval": "15s",
+        "static_configs": [{"targets": ["*:8081"]}],
+    }
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"scrape-interval": "often"},
+        {"scrape-timeout": "3m"},
+        {"telemetry-scrape-timeout": "30s"},
+        {"telemetry-sample-limit": -1},
+        {"label-limit": -1},
+        {"body-size-limit": "200M"},
+        {"drop-labels": "kube_pod_info=[__name__]"},
+        {"scrape-interval": "auto", "auto-scrape-interval-min": "10m"},
+        {"scrape-interval": "auto", "auto-scrape-duty-cycle": 0.0},
+    ],
+)
+def test_invalid(config):
+    with pytest.raises(ConfigError):
+        validate({**CONFIG, **config})
+
+
+def test_tiers():
+    tiers = parse_tiers("slow:10m:configmaps, secrets;fast:30s:pods;")
+    assert tiers == [
+        Tier("slow", "10m", ("configmaps", "secrets"), 8090, 8091),
+        Tier("fast", "30s", ("pods",), 8092, 8093),
+    ]
+    jobs = scrape_jobs(CONFIG, tiers)
+    assert [job["job_name"] for job in jobs] == [
+        "kube-state-metrics",
+        "kube-state-metrics-slow",
+        "kube-state-metrics-fast",
+        "telemetry",
+    ]
+    assert jobs[1]["scrape_interval"] == "10m"
+    assert jobs[1]["static_configs"] == [{"targets": ["*:8090"]}]
+    assert jobs[3]["static_configs"] == [{"targets": ["*:8081", "*:8091", "*:8093"]}]
+
+    for value in (
+        "slow:10m",
+        "Slow:10m:pods",
+        "a:1m:pods;a:2m:nodes",
+        "a:1m:pods;b:1m:pods",
+    ):
+        with pytest.raises(ConfigError):
+            parse_tiers(value)
+
+
+def test_compression():
+    # Prometheus requests compression by default, and versions before 2.49
+    # reject the settings
+    for job in scrape_jobs({**CONFIG, "compression": True}):
+        assert "enable_compression" not in job
+        assert "scrape_protocols" not in job
+
+
+def test_drop_labels():
+    assert parse_drop_labels("") == {}
+    assert parse_drop_labels("uid, kube_pod_info=[created_by_name, uid],") == {
+        None: ["uid"],
+        "kube_pod_info": ["created_by_name", "uid"],
+    }
+    assert metric_relabel_configs("uid,image_id,kube_pod_info=[host_ip]") == [
+        {"action": "labeldrop", "regex": "uid|image_id"},
+        {
+            "source_labels": ["__name__"],
+            "regex": "kube_pod_info",
+            "target_label": "host_ip",
+            "replacement": "",
+        },
+    ]
+    for value in ("kube-pod=[uid]", "kube_pod_info=[uid", "a b", "__name__"):
+        with pytest.raises(ConfigError):
+            parse_drop_labels(value)
+
+    state, telemetry = scrape_jobs({**CONFIG, "drop-labels": "uid"})
+    assert state["metric_relabel_configs"] == [{"action": "labeldrop", "regex": "uid"}]
+    assert "metric_relabel_configs" not in telemetry
+
+
+def test_auto_scrape():
+    config = {**CONFIG, "scrape-interval": "auto", "scrape-timeout": "3m"}
+    validate(config)
+    # until measured, scrape as rarely as allowed
+    assert auto_scrape(config) == (300, 300)
+    assert auto_scrape(config, current=(60, 10)) == (60, 10)
+
+    assert auto_scrape(config, 0.5) == (30, 10)
+    assert auto_scrape(config, 6.2) == (62, 19)
+    assert auto_scrape(config, 100) == (300, 300)
+    # small changes keep the current choice, unless it would time out
+    assert auto_scrape(config, 7, current=(62, 19)) == (62, 19)
+    assert auto_scrape(config, 9, current=(62, 19)) == (90, 27)
+    assert auto_scrape(config, 7, current=(62, 5)) == (70, 21)
+    # as do choices outside the band
+    assert auto_scrape(config, 4, current=(20, 10)) == (40, 12)
@@ -0,0 +1,24 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+import pytest
+
+from sharding import DEFAULT_WEIGHTS, parse_weights, partition_resources
+
+
+def test_parse_weights():
+    assert parse_weights("") == {}
+    assert parse_weights("pods=20, secrets=3,") == {"pods": 20, "secrets": 3}
+    for value in ("pods", "pods=x", "pods=0", "=3"):
+        with pytest.raises(ValueError):
+            parse_weights(value)
+
+
+def test_partition_resources():
+    resources = ["configmaps", "nodes", "pods", "replicasets", "secrets"]
+    partitions = partition_resources(resources, DEFAULT_WEIGHTS, 3)
+    assert partitions == [["pods"], ["replicasets"], ["configmaps", "nodes", "secrets"]]
+    # every resource is assigned exactly once
+    assert sorted(r for partition in partitions for r in partition) == resources
+
+    assert partition_resources(["nodes"], {}, 2) == [["nodes"], []]
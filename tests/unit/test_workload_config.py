@@ -0,0 +1,156 @@
+# Copyright 2021 Cory Johns
+# See LICENSE file for licensing details.
+
+import pytest
+import yaml
+
+from workload_config import ConfigError, compile_config
+
+
+def test_compile_flags():
+    compiled = compile_config(
+        {
+            "metric-allowlist": "kube_pod_info, kube_node_.*",
+            "metric-labels-allowlist": "=namespaces=[team,env],pods=[app]",
+            "metric-opt-in-list": "kube_pod_tolerations",
+            "namespaces": "default,kube-system",
+            "namespaces-denylist": "ci",
+            "resources": "",
+            "scrape-interval": "1m",
+        }
+    )
+    assert compiled.flags == (
+        "--metric-allowlist=kube_pod_info,kube_node_.*",
+        "--metric-labels-allowlist=namespaces=[team,env],pods=[app]",
+        "--metric-opt-in-list=kube_pod_tolerations",
+        "--namespaces=default,kube-system",
+        "--namespaces-denylist=ci",
+    )
+    assert compiled.warnings == ()
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"metric-allowlist": "foo", "metric-denylist": "bar"},
+        {"metric-denylist": "kube_pod_(info"},
+        {"metric-denylist": "kube_pod_(?!info)"},
+        {"metric-labels-allowlist": "pods=app"},
+        {"metric-labels-allowlist": "pods=[app,*]"},
+        {"namespaces": "Default"},
+        {"namespaces-denylist": "ci_*"},
+        {"metric-annotations-allowlist": "pods=[*,team]"},
+        {"metric-opt-in-list": "kube_pod_(tolerations"},
+    ],
+)
+def test_invalid(config):
+    with pytest.raises(ConfigError):
+        compile_config(config)
+
+
+def test_cost_warnings():
+    compiled = compile_config(
+        {"metric-allowlist": "kube_.*", "metric-labels-allowlist": "pods=[*]"}
+    )
+    assert len(compiled.warnings) == 2
+    assert "matches most metric families" in compiled.warnings[0]
+    assert "pods=[*]" in compiled.warnings[1]
+
+    compiled = compile_config({"metric-annotations-allowlist": "pods=[*]"})
+    assert len(compiled.warnings) == 1
+    assert "exposes every annotation of pods" in compiled.warnings[0]
+
+
+def test_cached():
+    config = {"namespaces": "default"}
+    assert compile_config(config) is compile_config(dict(config))
+
+
+CUSTOM_RESOURCE_STATE = """
+kind: CustomResourceStateMetrics
+spec:
+  resources:
+    - groupVersionKind:
+        group: myteam.io
+        version: v1
+        kind: Foo
+      labelsFromPath:
+        name: [metadata, name]
+      metrics:
+        - name: uptime
+          each:
+            type: Gauge
+            gauge:
+              path: [status, uptime]
+"""
+
+
+def test_custom_resource_state():
+    compiled = compile_config({"custom-resource-state": CUSTOM_RESOURCE_STATE})
+    assert compiled.flags == (
+        (
+            "--custom-resource-state-config-file="
+            "/etc/kube-state-metrics/custom-resource-state.yaml"
+        ),
+    )
+
+    too_many_labels = CUSTOM_RESOURCE_STATE.replace(
+        "        name: [metadata, name]\n",
+        "".join(f"        l{i}: [metadata, labels, l{i}]\n" for i in range(11)),
+    )
+    with pytest.raises(ConfigError, match="exceeding limit"):
+        compile_config({"custom-resource-state": too_many_labels})
+    with pytest.raises(ConfigError, match="kind must be"):
+        compile_config({"custom-resource-state": "spec: {}"})
+
+
+@pytest.mark.parametrize(
+    "replace",
+    [
+        ("spec:\n  resources:\n", "spec: foo\nbar:\n  resources:\n"),
+        ("    - groupVersionKind:", "    - foo\n    - groupVersionKind:"),
+        ("    - groupVersionKind:\n", "    - groupVersionKind: foo\n      bar:\n"),
+        ("      metrics:\n", "      metrics: bar\n      foo:\n"),
+        ("        - name: uptime\n", "        - bar\n        - name: uptime\n"),
+        ("          each:\n", "          each: bar\n          foo:\n"),
+        ("        name: [metadata, name]\n", "        - name\n"),
+    ],
+)
+def test_custom_resource_state_shapes(replace):
+    crs = CUSTOM_RESOURCE_STATE.replace(*replace)
+    assert crs != CUSTOM_RESOURCE_STATE
+    with pytest.raises(ConfigError):
+        compile_config({"custom-resource-state": crs})
+
+
+def test_config_file():
+    compiled = compile_config(
+        {
+            "metric-denylist": "kube_secret_.*",
+            "metric-labels-allowlist": "pods=[app,team]",
+            "metric-annotations-allowlist": "namespaces=[owner]",
+            "metric-opt-in-list": "kube_pod_tolerations",
+            "namespaces": "default",
+            "namespaces-denylist": "ci-1,ci-2",
+            "use-apiserver-cache": True,
+        },
+        config_file="/etc/kube-state-metrics/config.yaml",
+    )
+    # options which can't be reloaded stay on the command line
+    assert compiled.flags == (
+        "--use-apiserver-cache=true",
+        "--config=/etc/kube-state-metrics/config.yaml",
+    )
+    assert yaml.safe_load(compiled.config_file) == {
+        "metric_denylist": {"kube_secret_.*": {}},
+        "labels_allow_list": {"pods": ["app", "team"]},
+        "annotations_allow_list": {"namespaces": ["owner"]},
+        "metric_opt_in_list": {"kube_pod_tolerations": {}},
+        "namespaces": ["default"],
+        "namespaces_denylist": ["ci-1", "ci-2"],
+    }
+
+
+def test_compression():
+    compiled = compile_config({"compression": True})
+    assert compiled.flags == ("--enable-gzip-encoding=true",)